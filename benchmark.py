@@ -0,0 +1,233 @@
+#!/bin/python3
+
+# Time the slow parts of election.py and polls.py using synthetic data, and compare with earlier runs, e.g.:
+#   python3 benchmark.py states=28 poll_rows=100000 trials=20000
+# Results are added to benchmark_history.json. See README for details.
+
+import sys,os,re,csv,json,time,random,datetime,platform,tempfile,contextlib,io,statistics
+
+import election,polls
+
+def main():
+  pars = benchmark_parameters(sys.argv[1:])
+  rng = random.Random(pars['seed'])
+  results = {}
+  with tempfile.TemporaryDirectory() as work:
+    data_file = os.path.join(work,'data.csv')
+    polls_file = os.path.join(work,'polls.csv')
+    write_synthetic_states(data_file,polls_file,pars['states'],rng)
+    results.update(simulator_benchmarks(data_file,polls_file,pars))
+    poll_db = os.path.join(work,'president_polls.csv')
+    write_synthetic_polls(poll_db,pars['poll_rows'],rng)
+    results.update(poll_benchmarks(work,poll_db,pars['poll_rows'],pars['min_time']))
+  history = read_history(pars['history'])
+  scale = {'states':pars['states'],'poll_rows':pars['poll_rows'],'trials':pars['trials']}
+  regressions = report(results,earlier_results(history,scale),pars['threshold'])
+  history.append({'date':datetime.datetime.now().isoformat(timespec='seconds'),'python':platform.python_version(),
+                  'machine':platform.machine(),'numpy':not (election.np is None),'scale':scale,'results':results})
+  write_history(pars['history'],history)
+  if len(regressions)>0:
+    print(f"Possible regressions, slower by more than {int(100*pars['threshold'])}%: {', '.join(regressions)}")
+    sys.exit(1)
+
+def benchmark_parameters(args):
+  # Defaults, overridden by command-line arguments like states=100.
+  pars = {'states':28,'poll_rows':100000,'trials':20000,'seed':1,'threshold':0.2,'min_time':1.0,'history':'benchmark_history.json'}
+  for arg in args:
+    capture = re.search("^(.*)=(.*)$",arg)
+    if not capture or not (capture.group(1) in pars):
+      election.die(f"illegal argument {arg}, should be one of {list(pars.keys())} followed by =")
+    p,v = capture.group(1,2)
+    pars[p] = type(pars[p])(v)
+  # Every state or district has to have at least one electoral vote.
+  if pars['states']<2 or pars['states']>election.electoral_college_size():
+    election.die(f"states must be from 2 to {election.electoral_college_size()}")
+  return pars
+
+def n_unsafe_electoral_votes(n):
+  # As in the real data, 377 electoral votes aren't safe, unless there are so many states or districts that that's not enough.
+  return max(377,n)
+
+def write_synthetic_states(data_file,polls_file,n,rng):
+  """
+  Write a data file like data.csv, with n states named s000, s001, ..., and a matching polls file and safe.csv. The electoral
+  votes are a random split of the ones that aren't safe, the leans are random integers, and the polls are roughly consistent
+  with the leans, so that calibrate_lean_to_percent() has swing states to work with.
+  """
+  unsafe = n_unsafe_electoral_votes(n)
+  cuts = sorted(rng.sample(range(1,unsafe),n-1))
+  ev = [b-a for a,b in zip([0]+cuts,cuts+[unsafe])]
+  safe = election.electoral_college_size()-unsafe
+  with open(os.path.join(os.path.dirname(data_file),'safe.csv'),'w') as f:
+    f.write("state,electoral votes,party\n")
+    f.write(f"safe-d,{(safe*68)//(68+93)},d\n")
+    f.write(f"safe-r,{safe-(safe*68)//(68+93)},r\n")
+  with open(data_file,'w') as f:
+    f.write("state,electoral votes,lean,predictit\n")
+    lean = {}
+    for i in range(n):
+      state = f"s{i:03d}"
+      lean[state] = rng.randint(-3,3)
+      f.write(f"{state},{ev[i]},{lean[state]},{rng.uniform(0.05,0.95):.2f}\n")
+  with open(polls_file,'w') as f:
+    f.write("state,poll,undecided\n") # the first line is skipped
+    for state in lean:
+      if rng.random()<0.8:
+        f.write(f"{state},{3.0*lean[state]+rng.gauss(0.0,2.0):.1f},{rng.uniform(2.0,10.0):.1f}\n")
+
+def write_synthetic_polls(filename,n_rows,rng):
+  """
+  Write a file in the format of fivethirtyeight's president_polls.csv, with about n_rows rows, in reverse chronological order
+  like the real thing. Each poll has a row for each of the two candidates, and sometimes one for a third-party candidate.
+  Some polls are partisan, for the senate, or by pollsters with low grades, so that polls.py has something to throw away.
+  """
+  states = [name for name in polls.state_abbrev_table().keys()]
+  grades = ['A+','A','A-','B+','B','B-','B/C','C','D-','']
+  pollsters = [f"Pollster {i}" for i in range(40)]
+  end = datetime.datetime(2020,11,3)
+  header = ['question_id','poll_id','cycle','state','pollster','fte_grade','office_type','end_date','partisan','answer','pct']
+  with open(filename,'w',newline='') as f:
+    writer = csv.writer(f)
+    writer.writerow(header)
+    rows = 0
+    i = 0
+    while rows<n_rows:
+      date = (end-datetime.timedelta(days=(i*365)//max(1,n_rows//2))).strftime('%-m/%-d/%y')
+      state = rng.choice(states)
+      pollster = rng.choice(pollsters)
+      grade = rng.choice(grades)
+      partisan = rng.choice(['','','','','REP','DEM'])
+      office = rng.choice(['U.S. President','U.S. President','U.S. President','U.S. Senate'])
+      common = [i,i,2020,state,pollster,grade,office,date,partisan]
+      biden = rng.uniform(40.0,55.0)
+      writer.writerow(common+['Biden',f"{biden:.1f}"])
+      writer.writerow(common+['Trump',f"{rng.uniform(38.0,100.0-biden):.1f}"])
+      rows += 2
+      if rng.random()<0.1:
+        writer.writerow(common+['Jorgensen','1'])
+        rows += 1
+      i += 1
+
+def simulator_benchmarks(data_file,polls_file,pars):
+  # Returns a dict whose keys are the names of the benchmarks, and whose values are [rate,units].
+  defaults = os.path.join(os.path.dirname(os.path.abspath(__file__)),'defaults.txt')
+  ep = election.parameters(defaults,[f"seed={pars['seed']}",'engine=python'])
+  sd,dat = election.setup(ep,data_file,polls_file)
+  (lean,poll,predictit_prob,states) = (sd['lean'],sd['poll'],sd['predictit_prob'],sd['states'])
+  rng = random.Random(pars['seed'])
+  results = {}
+  results['state_data'] = [rate(lambda:election.state_data(data_file,polls_file),pars['min_time']),'calls/s']
+  presorted = sorted(rng.sample(states,len(states)),key=lambda s:lean[s]) # as in state_data(), before the real sorting
+  results['sort_states'] = [rate(lambda:election.sort_states(presorted,lean,poll,predictit_prob),pars['min_time']),'calls/s']
+  results['bubble_sort'] = [rate(lambda:election.bubble_sort(presorted,lean,poll,predictit_prob),pars['min_time']),'calls/s']
+  results['calibrate_lean_to_percent'] = [rate(lambda:election.calibrate_lean_to_percent(poll,lean),pars['min_time']),'calls/s']
+  results['do_one_trial'] = [rate(lambda:election.do_one_trial(dat,rng),pars['min_time']),'trials/s']
+  t = election.do_one_trial(dat,rng)
+  results['tipping_point'] = [rate(lambda:election.tipping_point(dat['safe_d'],dat['safe_r'],t['vote'],dat['electoral_votes'],
+                                   dat['tie'],t['d_win'],2),pars['min_time']),'calls/s']
+  n = pars['trials']
+  results['run_trials_python'] = [n*rate(lambda:election.run_trials(ep,dat,n,('','')),pars['min_time']),'trials/s']
+  if not (election.np is None):
+    ep['engine'] = 'numpy'
+    results['run_trials_numpy'] = [n*rate(lambda:election.run_trials(ep,dat,n,('','')),pars['min_time']),'trials/s']
+    results['exact_probabilities'] = [rate(lambda:election.exact_probabilities(dat,('','')),pars['min_time']),'calls/s']
+  return results
+
+def poll_benchmarks(work,poll_db,n_rows,min_time):
+  # Parsing only, and then all of polls.py from scratch, including writing polls.csv, in rows of input per second.
+  results = {}
+  with open(poll_db,'rb') as f:
+    header = next(csv.reader([f.readline().decode('utf-8')]))
+    start = f.tell()
+    end = os.path.getsize(poll_db)
+  candidates = ("biden","trump")
+  def parse():
+    polls.pair_polls(polls.filtered_rows(poll_db,header,start,end,candidates),candidates)
+  results['polls_parse'] = [n_rows*rate(parse,min_time),'rows/s']
+  def whole_script():
+    if os.path.exists('polls_checkpoint.json'):
+      os.remove('polls_checkpoint.json')
+    with contextlib.redirect_stdout(io.StringIO()):
+      polls.main()
+  old_dir = os.getcwd()
+  os.chdir(work)
+  old_argv = sys.argv
+  sys.argv = ['polls.py']
+  try:
+    results['polls_end_to_end'] = [n_rows*rate(whole_script,min_time),'rows/s']
+  finally:
+    sys.argv = old_argv
+    os.chdir(old_dir)
+  return results
+
+def rate(f,min_time):
+  """
+  Number of calls to f per second. This is measured n_rounds() times, each time calling f repeatedly for at least
+  min_time/n_rounds() seconds, and at least once, and the fastest round is used, since the slower ones are the ones that
+  were slowed down by other things happening on the machine.
+  """
+  best = 0.0
+  for round in range(n_rounds()):
+    n = 0
+    start = time.perf_counter()
+    while True:
+      f()
+      n += 1
+      elapsed = time.perf_counter()-start
+      if elapsed>=min_time/n_rounds():
+        break
+    best = max(best,n/elapsed)
+  return best
+
+def n_rounds():
+  return 3
+
+def earlier_results(history,scale):
+  """
+  For each benchmark, the median of the rates from the last few runs at the same scale, or an empty dict if there
+  weren't any. Using the median means that one unusually fast or slow run doesn't set off false alarms.
+  """
+  runs = [h['results'] for h in history if h['scale']==scale][-n_runs_to_compare():]
+  result = {}
+  for run in runs:
+    for name in run:
+      result.setdefault(name,[]).append(run[name][0])
+  for name in result:
+    result[name] = statistics.median(result[name])
+  return result
+
+def n_runs_to_compare():
+  return 5
+
+def report(results,earlier,threshold):
+  # Print a table, and return a list of the benchmarks that are slower than before by more than the threshold.
+  regressions = []
+  print("benchmark                         rate                    earlier      change")
+  for name in results:
+    r,units = results[name]
+    line = f"{name.ljust(28)}{r:12.4g} {units.ljust(10)}"
+    if name in earlier:
+      change = r/earlier[name]-1.0
+      flag = ''
+      if change< -threshold:
+        flag = ' !'
+        regressions.append(name)
+      line = line+f"{earlier[name]:12.4g}    {100*change:+6.1f}%{flag}"
+    print(line)
+  return regressions
+
+def read_history(filename):
+  try:
+    with open(filename) as f:
+      return json.load(f)
+  except OSError:
+    return []
+
+def write_history(filename,history):
+  temp = filename+".temp"
+  with open(temp,'w') as f:
+    json.dump(history,f,indent=1)
+  os.replace(temp,filename)
+
+if __name__=='__main__':
+  main()
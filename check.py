@@ -0,0 +1,158 @@
+#!/bin/python3
+
+# Check that the different ways of getting the same results agree with each other, e.g.:
+#   python3 check.py trials=200000
+# Prints one line per check, and exits with an error if any of them failed. Requires numpy. See README for details.
+
+import sys,os,re,json,random,tempfile,contextlib,io
+
+import election,polls,benchmark
+
+def main():
+  pars = check_parameters(sys.argv[1:])
+  if election.np is None:
+    election.die("check.py requires the numpy library")
+  os.chdir(os.path.dirname(os.path.abspath(__file__))) # election.py reads its input files from the current directory
+  failed = []
+  for name,check in [('exact and Monte Carlo agree',check_exact_vs_trials),
+                     ('checkpoint and extend give the same totals as one run',check_checkpoint_extend),
+                     ('trial store gives the same answers as simulate_outcomes()',check_trial_store),
+                     ('polls.py gives the same results incrementally as from scratch',check_polls_incremental)]:
+    problem = check(pars)
+    if problem is None:
+      print(f"ok      {name}")
+    else:
+      print(f"FAILED  {name}: {problem}")
+      failed.append(name)
+  if len(failed)>0:
+    sys.exit(1)
+
+def check_parameters(args):
+  # Defaults, overridden by command-line arguments like trials=1000000.
+  pars = {'trials':100000,'seed':1,'n_se':4.0,'poll_rows':20000}
+  for arg in args:
+    capture = re.search("^(.*)=(.*)$",arg)
+    if not capture or not (capture.group(1) in pars):
+      election.die(f"illegal argument {arg}, should be one of {list(pars.keys())} followed by =")
+    p,v = capture.group(1,2)
+    pars[p] = type(pars[p])(v)
+  return pars
+
+def simulation(args):
+  # Parameters and data for election.py with the usual input files, as if args were given on the command line.
+  ep = election.parameters('defaults.txt',args)
+  sd,dat = election.setup(ep,'data.csv','polls.csv')
+  return (ep,dat)
+
+def check_exact_vs_trials(pars):
+  """
+  The probabilities of D winning the election and each state, from engine=exact and from each Monte Carlo engine, should differ by
+  no more than n_se standard errors. The python engine is much slower, so it only gets a tenth as many trials.
+  """
+  ep,dat = simulation([f"seed={pars['seed']}"])
+  joint = ('','')
+  exact = election.exact_probabilities(dat,joint)
+  for engine,n_trials in [('numpy',pars['trials']),('python',max(1,pars['trials']//10))]:
+    ep['engine'] = engine
+    acc = election.run_trials(ep,dat,n_trials,joint)
+    n = acc['n']
+    for state in ['nat']+list(dat['electoral_votes'].keys()):
+      if state=='nat':
+        (p,x) = (exact['d_wins'],acc['d_wins'])
+      else:
+        (p,x) = (exact['state_d_wins'][state],acc['state_d_wins'][state])
+      se = max((p*(1.0-p)/n)**0.5,1.0/n)
+      if abs(x/n-p)>pars['n_se']*se:
+        return f"for {election.ps(state).strip()}, engine=exact gives {p:.5f}, but engine={engine} gives {x/n:.5f}, with se={se:.5f}"
+  return None
+
+def check_checkpoint_extend(pars):
+  """
+  A run that's saved in a checkpoint and then extended, with a partial block at the end, should give exactly the same totals as a
+  single run with all the trials, since the blocks get the same random numbers and are merged in the same order.
+  """
+  block = election.trial_block_size()
+  (first,more) = (2*block+block//3,block+block//2)
+  joint = ('','')
+  with tempfile.TemporaryDirectory() as work:
+    filename = os.path.join(work,'run.json')
+    ep,dat = simulation([f"seed={pars['seed']}",'engine=numpy',f"n_trials={first}",f"checkpoint={filename}"])
+    election.run_with_checkpoints(ep,dat,joint,filename)
+    ep['extend'] = more
+    extended = election.run_with_checkpoints(ep,dat,joint,filename)
+  ep,dat = simulation([f"seed={pars['seed']}",'engine=numpy'])
+  single = election.run_trials(ep,dat,first+more,joint)
+  if election.accumulators_to_json(extended)!=election.accumulators_to_json(single):
+    return f"{first} trials extended by {more} don't match a single run of {first+more}"
+  return None
+
+def check_trial_store(pars):
+  # Answers from a trial store should be exactly the same as from simulate_outcomes() with the same seed.
+  ep,dat = simulation([])
+  n_trials = pars['trials']
+  trials = election.simulate_outcomes(dat,n_trials,pars['seed'])
+  states = trials['states']
+  queries = [('nat',''),('!nat',''),(states[0],''),('nat',states[-1]),(f"{states[0]} & !{states[1]} | {states[2]}",f"!nat | {states[3]}")]
+  with tempfile.TemporaryDirectory() as work:
+    filename = os.path.join(work,'trials.bin')
+    election.write_trial_store(filename,dat,n_trials,pars['seed'])
+    store = election.open_trial_store(filename)
+    for event,given in queries:
+      (a,b) = (election.probability(trials,event,given),election.probability(store,event,given))
+      if a!=b:
+        return f"for P({event} given {given}), simulate_outcomes() gives {a}, but the trial store gives {b}"
+    del store # close the memory-mapped files before the directory is removed
+  return None
+
+def check_polls_incremental(pars):
+  """
+  Process the older part of a synthetic president_polls.csv, then add the newer polls at the top, the way fivethirtyeight does,
+  and process it again, which only reads the new rows. The results should be the same as processing the whole file from scratch.
+  Since all the synthetic polls may be too old to make it into polls.csv, the most recent polls saved in the checkpoint are compared too.
+  """
+  with tempfile.TemporaryDirectory() as work:
+    poll_db = os.path.join(work,'president_polls.csv')
+    benchmark.write_synthetic_polls(poll_db,pars['poll_rows'],random.Random(pars['seed']))
+    with open(poll_db,'rb') as f:
+      lines = f.readlines()
+    # Split between two polls, rather than between the rows for the candidates in one poll.
+    split = len(lines)//2
+    while split<len(lines) and lines[split].split(b',')[0]==lines[split-1].split(b',')[0]:
+      split += 1
+    with open(poll_db,'wb') as f:
+      f.writelines(lines[:1]+lines[split:])
+    run_polls(work)
+    with open(poll_db,'wb') as f:
+      f.writelines(lines)
+    incremental = run_polls(work)
+    os.remove(os.path.join(work,'polls_checkpoint.json'))
+    full = run_polls(work)
+  if not incremental[2].startswith("Processing "+str(sum(len(line) for line in lines[1:split]))):
+    return "the second run didn't process just the new data"
+  if incremental[0]!=full[0]:
+    return "polls.csv is different"
+  if incremental[1]!=full[1]:
+    return "the polls saved in polls_checkpoint.json are different"
+  return None
+
+def run_polls(work):
+  # Run polls.py in the directory work, and return the contents of polls.csv, the polls saved in the checkpoint, and what was printed.
+  old_dir = os.getcwd()
+  os.chdir(work)
+  old_argv = sys.argv
+  sys.argv = ['polls.py']
+  printed = io.StringIO()
+  try:
+    with contextlib.redirect_stdout(printed):
+      polls.main()
+    with open('polls.csv') as f:
+      output = f.read()
+    with open('polls_checkpoint.json') as f:
+      latest = json.load(f)['by_state']
+  finally:
+    sys.argv = old_argv
+    os.chdir(old_dir)
+  return (output,latest,printed.getvalue())
+
+if __name__=='__main__':
+  main()
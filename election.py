@@ -1,12 +1,23 @@
 #!/bin/python3
 
-import math,random,statistics,sys,csv,re,copy,datetime
+import math,random,statistics,sys,csv,re,copy,datetime,multiprocessing,os,json,hashlib,io,time,functools,warnings
 
-def parameters(filename):
+try:
+  import numpy as np
+except ImportError:
+  np = None # only needed for engine=numpy
+
+try:
+  import resource
+except ImportError:
+  resource = None # only used for reporting peak memory with profile=1; not available on windows
+
+def parameters(filename,args=None):
   '''
   Set adjustable parameters. The main parameters that it makes sense to fiddle with are A, k, s, and dist.
   See README for how to decide on these values.
-  The defaults can be overridden from the command line, e.g., election.py a=10.
+  The defaults can be overridden from the command line, e.g., election.py a=10. If args is given, it is used
+  instead of the command line, e.g., ['a=10'].
   '''
 
   pars = get_defaults_from_file(filename)
@@ -22,25 +33,231 @@ def parameters(filename):
 
   pars['rho'] = (rho1,rho2,rho3)
   pars['joint'] = ('','')
-
-  pars['a'] = guess_national_variability()
-
-  pars = get_command_line_pars(pars) # override defaults
+  pars['store'] = '' # file for saving every trial, see write_trial_store()
+  pars['query'] = '' # event to look up in the stored trials, see probability()
+  pars['given'] = '' # condition for the query
+  pars['correlation'] = '' # file with correlations among the states' own fluctuations, see correlation_factor()
+  pars['timeline'] = '' # range of dates, see timeline()
+  pars['timeline_polls'] = '' # poll averages for each date, written by polls.py, for use with timeline
+  pars['profile_json'] = '' # file for writing the timings from profile=1
+  pars['races'] = '' # file of senate or house races to simulate along with the presidential race, see race_data()
+  pars['scenarios'] = '' # experts, and/or files of changes to the leans and polls, to compare, see scenarios()
+  pars['checkpoint'] = '' # file for saving the totals during a long run, so that it can be resumed or extended, see run_with_checkpoints()
+  for p in ['a','k','s','dist']:
+    pars['sweep_'+p] = [] # grid of values for a parameter sweep; see sweep()
+
+  if not ('a' in pars):
+    pars['a'] = guess_national_variability() # unless it was set in the file, e.g., by calibrate=1
+
+  pars = get_command_line_pars(pars,args) # override defaults
 
   return pars
 
 def main():
 
   pars = parameters('defaults.txt')
-  (a,k,s,dist,rho,n_trials,joint,tie) = (pars['a'],pars['k'],pars['s'],pars['dist'],pars['rho'],pars['n_trials'],pars['joint'],pars['tie'])
-  (rho1,rho2,rho3) = rho
-
-  sd = state_data('data.csv','polls.csv')
+  if pars['profile']==1:
+    start_profiling()
+  (n_trials,joint) = (pars['n_trials'],pars['joint'])
+  sd,dat = setup(pars,'data.csv','polls.csv')
   (electoral_votes,lean,predictit_prob,poll,undecided,safe_d,safe_r,tot,states) = (
             sd['electoral_votes'],sd['lean'],sd['predictit_prob'],sd['poll'],sd['undecided'],
             sd['safe_d'],sd['safe_r'],sd['tot'],sd['states'])
+  (aa,c,ind) = (dat['aa'],dat['c'],dat['ind'])
+
+  if pars['calibrate']==1:
+    calibrate(pars,dat,sd,'defaults.txt','calibrated.txt')
+    return
+  if is_sweep(pars):
+    sweep(pars,dat,sd,'sweep.csv')
+    return
+  if pars['scenarios']!='':
+    scenarios(pars,dat,sd,'data.csv','scenarios.csv')
+    return
+  if pars['store']!='':
+    trial_store_command(pars,dat)
+    return
+  if pars['pairs']==1:
+    pair_matrices(pars,dat,sd,'pairs.json')
+    return
+  if pars['timeline']!='':
+    timeline(pars,dat,sd,'timeline.csv')
+    return
+  if pars['replay']>0:
+    replay_trial(pars,dat,pars['replay'])
+    return
+  if pars['extend']>0 and pars['checkpoint']=='':
+    die("extend requires checkpoint=...")
+  if pars['sensitivity']==1:
+    check_array_engine(pars,"sensitivity=1") # before the main run, rather than after it
+  acc = None
+  use_cache = is_cacheable(pars)
+  if use_cache:
+    key = cache_key(pars,input_files(pars))
+    acc = read_cache(key)
+    if not (acc is None):
+      acc = accumulators_from_json(acc)
+  if acc is None:
+    if pars['checkpoint']!='':
+      acc = run_with_checkpoints(pars,dat,joint,pars['checkpoint'])
+    elif pars['engine']=='exact':
+      acc = exact_probabilities(dat,joint)
+    elif pars['se']>0.0:
+      acc = run_until_precise(pars,dat,n_trials,joint,listed_states(pars,sd))
+    else:
+      acc = run_trials(pars,dat,n_trials,joint)
+    if use_cache:
+      write_cache(key,accumulators_to_json(acc))
+  n = acc['n'] # total weight of all trials; for engine=exact, this is 1 and everything is already a probability
+  errors = None
+  if (pars['se']>0.0 or pars['tilt']>0.0 or pars['sampling']!='plain') and pars['engine']!='exact':
+    errors = standard_errors(acc)
+  d_wins,state_d_wins,rcl,joint_table,tipping_histogram = (acc['d_wins'],acc['state_d_wins'],
+            acc['rcl'],acc['joint_table'],acc['tipping_histogram'])
+  electoral_college_histogram = predictit_histogram(acc['ev_histogram'])
+  vote_avg = {}
+  for state in states:
+    vote_avg[state] = acc['vote_sum'][state]/n
+  prob = {}
+  for state in states:
+    prob[state] = state_d_wins[state]/n
+    if prob[state]>0.0:
+      rcl[state] = rcl[state]/(n*prob[state]) # number of times the joint event happened, divided by the number of times the
+                                                     # even conditioned on happened
+    else:
+      rcl[state] = None
+
+  d_prob = d_wins/n
+  output(pars,
+         {'d_prob':d_prob,'prob':prob,'rcl':rcl,'joint_table':joint_table,'aa':aa,'c':c,'n':n,'errors':errors},
+         {'electoral_votes':electoral_votes,'lean':lean,'predictit_prob':predictit_prob,'poll':poll,'undecided':undecided,
+            'safe_d':safe_d,'safe_r':safe_r,'tot':tot,'states':states,'ind':ind,'vote_avg':vote_avg,
+            'electoral_college_histogram':electoral_college_histogram,'tipping_histogram':tipping_histogram}
+        )
+  output_distributions(acc,states)
+  write_electoral_college_histogram('histogram.txt',electoral_college_histogram,n,pars['tilt']>0.0)
+  write_electoral_vote_distribution('electoral_votes.csv',acc['ev_histogram'],n)
+  write_margin_percentiles('margins.csv',acc,states)
+  if not (tipping_histogram is None): # engine=exact doesn't calculate tipping points
+    write_tipping_histogram('tipping.txt',tipping_histogram,n,states)
+  if not (acc['races'] is None):
+    output_races(acc,dat)
+  if pars['sensitivity']==1:
+    sensitivity(pars,dat,sd,'sensitivity.csv')
+  if not (profile is None):
+    report_profile(pars,acc)
+
+
+profile = None # timings for profile=1, see start_profiling()
+
+def start_profiling():
+  """
+  Start keeping track of how much time is spent in each phase of the run. This works by replacing each of the functions listed in
+  profiled_functions() with a version that times it, so when profiling is off, nothing is slowed down at all. The time in a
+  phase doesn't include time spent in other phases nested inside it, e.g., the trials don't include the tipping points. Time spent
+  in worker processes, with workers>1, isn't broken down into phases.
+  """
+  global profile
+  profile = {'phases':{},'nested':[],'draws':0,'start':(time.perf_counter(),time.process_time())}
+  g = globals()
+  for name,phase in profiled_functions().items():
+    g[name] = profiled(phase,g[name])
+  for name in ['bell_curve','bell_curve_array','sampled_uniforms']:
+    g[name] = counting_draws(g[name])
+
+def profiled_functions():
+  # The functions that are timed by profile=1, and the phases they're counted in.
+  return {'state_data':'load data','read_timeline_polls':'load data','correlation_factor':'load data','race_data':'load data',
+          'calibrate_lean_to_percent':'calibrate',
+          'run_trials':'trials','run_until_precise':'trials','exact_probabilities':'trials',
+          'tipping_point_index':'tipping points','tipping_points_array':'tipping points',
+          'read_cache':'cache','write_cache':'cache',
+          'output':'output','output_distributions':'output','write_electoral_college_histogram':'histograms',
+          'write_tipping_histogram':'histograms','write_electoral_vote_distribution':'histograms','write_margin_percentiles':'histograms'}
+
+def profiled(phase,f):
+  def timed(*args,**kwargs):
+    start = (time.perf_counter(),time.process_time())
+    profile['nested'].append([0.0,0.0]) # time in phases nested inside this one
+    try:
+      return f(*args,**kwargs)
+    finally:
+      wall,cpu = (time.perf_counter()-start[0],time.process_time()-start[1])
+      nested = profile['nested'].pop()
+      if not (phase in profile['phases']):
+        profile['phases'][phase] = {'wall':0.0,'cpu':0.0,'calls':0}
+      profile['phases'][phase]['wall'] += wall-nested[0]
+      profile['phases'][phase]['cpu'] += cpu-nested[1]
+      profile['phases'][phase]['calls'] += 1
+      if len(profile['nested'])>0:
+        profile['nested'][-1][0] += wall
+        profile['nested'][-1][1] += cpu
+  return timed
+
+def counting_draws(f):
+  # Wrap bell_curve(), bell_curve_array(), or sampled_uniforms() so that profile=1 can count how many random numbers are drawn.
+  def counted(*args,**kwargs):
+    x = f(*args,**kwargs)
+    if np is None:
+      profile['draws'] += 1
+    else:
+      profile['draws'] += int(np.size(x))
+    return x
+  return counted
+
+def report_profile(pars,acc):
+  """
+  Print a table of the timings from profile=1, and if profile_json was given, write them to that file. Random numbers drawn
+  in worker processes, with workers>1, aren't counted.
+  """
+  wall = time.perf_counter()-profile['start'][0]
+  cpu = time.process_time()-profile['start'][1]
+  phases = profile['phases']
+  other = {'wall':wall-sum([p['wall'] for p in phases.values()]),'cpu':cpu-sum([p['cpu'] for p in phases.values()]),'calls':None}
+  result = {'phases':dict(phases,other=other),'wall':wall,'cpu':cpu,'trials':None,'trials_per_second':None,'draws_per_trial':None,
+            'peak_memory_mb':None}
+  if 'trials' in phases and pars['engine']!='exact':
+    result['trials'] = acc['n']
+    result['trials_per_second'] = acc['n']/(phases['trials']['wall']+phases.get('tipping points',{'wall':0.0})['wall'])
+    if pars['workers']<=1:
+      result['draws_per_trial'] = profile['draws']/acc['n']
+  if not (resource is None):
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform!='darwin':
+      peak *= 1024 # linux gives kilobytes, macos gives bytes
+    result['peak_memory_mb'] = peak/1024**2
+  print("")
+  print("phase                wall (s)    cpu (s)     calls")
+  for name in list(phases.keys())+['other']:
+    p = result['phases'][name]
+    calls = '' if p['calls'] is None else str(p['calls'])
+    print(f"{name.ljust(18)}{p['wall']:10.3f}{p['cpu']:11.3f}{calls.rjust(10)}")
+  print(f"{'total'.ljust(18)}{wall:10.3f}{cpu:11.3f}")
+  if not (result['trials_per_second'] is None):
+    print(f"trials per second: {result['trials_per_second']:.4g}")
+  if not (result['draws_per_trial'] is None):
+    print(f"random numbers drawn per trial: {result['draws_per_trial']:.4g}")
+  if not (result['peak_memory_mb'] is None):
+    print(f"peak memory: {result['peak_memory_mb']:.1f} Mb")
+  if pars['profile_json']!='':
+    with open(pars['profile_json'],'w') as f:
+      json.dump(result,f,indent=1)
+
+def setup(pars,data_file,polls_file):
+  """
+  Read the data files and work out everything that the simulation needs to know. Returns (sd,dat), where sd is
+  the data about the states returned by state_data(), and dat has the inputs to the simulation itself.
+  This is the starting point for using this file as a library, e.g.:
+    pars = election.parameters('defaults.txt',['a=3'])
+    sd,dat = election.setup(pars,'data.csv','polls.csv')
+    trials = election.simulate_outcomes(dat,100000,seed=1)
+    election.probability(trials,'!nat',given='!pa')
+  """
+  (a,k,s,dist,rho,tie) = (pars['a'],pars['k'],pars['s'],pars['dist'],pars['rho'],pars['tie'])
+
+  sd = state_data(data_file,polls_file)
+  (electoral_votes,lean,poll,safe_d,safe_r,tot) = (sd['electoral_votes'],sd['lean'],sd['poll'],sd['safe_d'],sd['safe_r'],sd['tot'])
 
-  n = len(electoral_votes) # number of swing states
   c,auto_k = calibrate_lean_to_percent(poll,lean)
   #k = k+auto_k
   # ... if this is uncommented, then we distrust the experts and adjust k; did this in late summer 2020 because experts' ratings were
@@ -48,65 +265,2326 @@ def main():
   aa = math.sqrt(math.pi/2.0)*a # Convert mean absolute value to std dev, assuming normal, even if normal isn't what we're actually using.
                                 # See notes on how choice of distribution function affects A.
 
-  ind = {} # uncorrelated std dev of each state
+  ind = state_weights(electoral_votes,rho) # uncorrelated std dev of each state
+  for state in electoral_votes:
+    ind[state] *= (aa*s)
+
+  cholesky = None
+  if pars['correlation']!='':
+    cholesky = correlation_factor(pars['correlation'],list(electoral_votes.keys()),pars['cache']==1)
+
+  races = None
+  if pars['races']!='':
+    races = race_data(pars['races'],electoral_votes,rho,aa,s,c)
+
+  dat = {'safe_d':safe_d,'safe_r':safe_r,'aa':aa,'k':k,'s':s,'dist':dist,'tot':tot,'c':c,
+                 'ind':ind,'electoral_votes':electoral_votes,'lean':lean,'tie':tie,
+                 'tilt':pars['tilt'],'tilt_states':pars['tilt_states'],'cholesky':cholesky,'races':races,'sampling':pars['sampling']}
+  return (sd,dat)
+
+def input_files(pars):
+  # The files that the results depend on, for use in cache_key().
+  files = ['data.csv','polls.csv','safe.csv']
+  if pars['correlation']!='':
+    files.append(pars['correlation'])
+  if pars['races']!='':
+    files.append(pars['races'])
+  return files
+
+def race_data(filename,electoral_votes,rho,aa,s,c):
+  """
+  Read a file of senate or house races, to be simulated in the same trials as the presidential race, e.g.,
+    chamber,race,seats,party,lean,poll
+    senate,not up d,35,d,,
+    senate,not up r,30,r,,
+    senate,az-sen,1,,-1,4.5
+    senate,me-sen,1,,0,
+  A row with a lean, on the same scale as in data.csv, is a contested race, and the poll, if any, is the average D-R margin.
+  A row with a party, d or r, instead stands for seats that are safe for that party or aren't up for election. Each race
+  gets the same national shock as the states, plus its own fluctuation, of the same size as a typical state's. If a chamber
+  has polls for enough swing races, its own value of c is calculated from them, otherwise the one for the states is used.
+  """
+  races = {'chambers':[],'chamber':{},'seats':{},'lean':{},'poll':{},'ind':{},'c':{},'safe_d':{},'safe_r':{},'total':{}}
+  with open(filename,newline='') as csv_file:
+    csv_reader = csv.reader(csv_file)
+    next(csv_reader) # titles
+    for row in csv_reader:
+      if len(row)==0:
+        continue
+      chamber,race,seats,party,lean,poll = [x.strip().lower() for x in (row+['']*6)[:6]]
+      if not (chamber in races['chambers']):
+        races['chambers'].append(chamber)
+        for key in ['safe_d','safe_r','total']:
+          races[key][chamber] = 0
+      races['total'][chamber] += int(seats)
+      if party!='':
+        if not (party in ['d','r']):
+          die(f"party for {race} in {filename} should be d or r, not {party}")
+        races['safe_'+party][chamber] += int(seats)
+        continue
+      if race in electoral_votes or race in races['seats'] or race=='nat' or race in races['chambers']:
+        die(f"the name of the race {race} in {filename} is already used for a state, a chamber, or another race")
+      if lean=='':
+        die(f"{race} in {filename} should have either a lean or a party")
+      races['chamber'][race] = chamber
+      races['seats'][race] = int(seats)
+      races['lean'][race] = float(lean)
+      races['poll'][race] = None if poll=='' else float(poll)
+      races['ind'][race] = correlation_to_weight(rho[0])*aa*s
+  for chamber in races['chambers']:
+    if chamber in electoral_votes or chamber=='nat':
+      die(f"the name of the chamber {chamber} in {filename} is already used for a state")
+    in_chamber = [race for race in races['seats'] if races['chamber'][race]==chamber]
+    races['c'][chamber] = race_calibration({race:races['poll'][race] for race in in_chamber},races['lean'],c)
+  return races
+
+def race_calibration(poll,lean,c):
+  # The value of c for a chamber, or the one for the states, c, if there aren't enough polls of swing races to calculate it.
+  swing = [race for race in poll if not (poll[race] is None) and abs(lean[race])<=2 and abs(poll[race])<6.0]
+  if len(swing)<3 or len(set([lean[race] for race in swing]))<2:
+    return c
+  return calibrate_lean_to_percent({race:poll[race] for race in swing},lean)[0]
+
+def correlation_factor(filename,states,use_cache=True):
+  """
+  Read a matrix of correlations among the states' own fluctuations, i.e., the part of each state's randomness that isn't the
+  nationally correlated shift, and return its Cholesky factor L, as an array with rows and columns in the order given by states.
+  Multiplying a vector of independent normal random numbers by L then gives correlated ones. The file is a csv file whose first row is
+  a list of states, and each of whose other rows starts with a state and gives its correlations with these states, e.g.,
+    state,mi,wi,pa
+    mi,1,0.5,0.4
+    wi,0.5,1,0.4
+    pa,0.4,0.4,1
+  A pair of states that isn't in the file is uncorrelated. Since the factorization only has to be redone when the file changes,
+  the result is saved in the cache, under a hash of the file's contents and the list of states, unless use_cache is false.
+  """
+  if np is None:
+    die("correlation requires the numpy library")
+  try:
+    with open(filename,'rb') as f:
+      contents = f.read()
+  except OSError:
+    die(f"can't read correlation file {filename}")
+  h = hashlib.sha256()
+  h.update(json.dumps({'cholesky':states,'engine_version':engine_version()}).encode('utf-8'))
+  h.update(contents)
+  key = h.hexdigest()
+  if use_cache:
+    cached = read_cache(key)
+    if not (cached is None):
+      return np.array(cached)
+  col = {}
+  for i in range(len(states)):
+    col[states[i]] = i
+  r = np.identity(len(states))
+  rows = list(csv.reader(io.StringIO(contents.decode('utf-8'))))
+  header = [x.strip().lower() for x in rows[0][1:]]
+  for row in rows[1:]:
+    if len(row)==0:
+      continue
+    state = row[0].strip().lower()
+    for j in range(len(header)):
+      if not (state in col) or not (header[j] in col):
+        die(f"unknown state in correlation file {filename}: {state} or {header[j]}")
+      r[col[state],col[header[j]]] = float(row[j+1])
+  if not np.allclose(r,r.T):
+    die(f"correlation matrix in {filename} isn't symmetric")
+  if not np.allclose(np.diag(r),1.0):
+    die(f"correlation matrix in {filename} should have 1's on the diagonal")
+  try:
+    cholesky = np.linalg.cholesky(r)
+  except np.linalg.LinAlgError:
+    die(f"correlation matrix in {filename} isn't positive definite")
+  if use_cache:
+    write_cache(key,cholesky.tolist())
+  return cholesky
+
+def state_weights(electoral_votes,rho):
+  # Size of each state's uncorrelated fluctuations, relative to the national ones, before multiplying by the fudge factor s.
+  (rho1,rho2,rho3) = rho
+  ind = {}
   for state in electoral_votes:
     ind[state] = correlation_to_weight(rho1)
-  ind['fl'] = correlation_to_weight(rho2)
-  ind['nv'] = correlation_to_weight(rho3)
+  if 'fl' in ind:
+    ind['fl'] = correlation_to_weight(rho2)
+  if 'nv' in ind:
+    ind['nv'] = correlation_to_weight(rho3)
+  return ind
+
+def is_sweep(pars):
+  for p in ['a','k','s','dist']:
+    if len(pars['sweep_'+p])>0:
+      return True
+  return False
+
+def sweep(pars,dat,sd,filename):
+  """
+  Calculate the probability of a D win, and of D winning each state, for every combination of the values of a, k, s, and dist
+  given in the parameters sweep_a, etc. A parameter that isn't swept keeps its usual value. The random numbers are uniform
+  variables that are drawn once and converted into bell-curve values for every point on the grid, so differences between grid
+  points aren't swamped by random noise. Results are printed and written to a csv file.
+  """
+  check_array_engine(pars,"a parameter sweep",False)
+  if not (dat['cholesky'] is None):
+    die("a parameter sweep can't be used with correlation")
+  (safe_d,c,electoral_votes,lean,tie,tot) = (dat['safe_d'],dat['c'],dat['electoral_votes'],dat['lean'],dat['tie'],dat['tot'])
+  states = sd['states']
+  ev = np.array([electoral_votes[state] for state in states])
+  weight = state_weights(electoral_votes,pars['rho'])
+  weight_v = np.array([weight[state] for state in states])
+  lean_v = np.array([lean[state] for state in states])
+  grid = []
+  for a in (pars['sweep_a'] or [pars['a']]):
+    for k in (pars['sweep_k'] or [pars['k']]):
+      for s in (pars['sweep_s'] or [pars['s']]):
+        for dist in (pars['sweep_dist'] or [pars['dist']]):
+          grid.append((a,k,s,dist))
+  seed = resolved_seed(pars)
+  rng = np.random.default_rng(seed)
+  d_wins = np.zeros(len(grid))
+  state_d_wins = np.zeros((len(grid),len(states)))
+  n_trials = pars['n_trials']
+  for start in range(0,n_trials,numpy_chunk_size()):
+    m = min(numpy_chunk_size(),n_trials-start)
+    u0 = rng.random(m)
+    u = rng.random((m,len(states)))
+    z0,z = ({},{})
+    for dist in set([g[3] for g in grid]):
+      z0[dist] = bell_curve_inverse_cdf(dist,u0)
+      z[dist] = bell_curve_inverse_cdf(dist,u)
+    for g in range(len(grid)):
+      a,k,s,dist = grid[g]
+      aa = math.sqrt(math.pi/2.0)*a
+      x = aa*z0[dist][:,None]+aa*s*weight_v*z[dist]+c*(lean_v+k) # no need to apply bell_to_200_percent_range(), which doesn't change the sign
+      state_d_win = (x>0.0)
+      d = safe_d+state_d_win.astype(np.int64)@ev
+      d_wins[g] += np.count_nonzero((d*2>tot) | ((d*2==tot) & (tie==1)))
+      state_d_wins[g] += np.count_nonzero(state_d_win,axis=0)
+  print("      a      k      s  dist    prob of D win")
+  with open(filename,'w') as f:
+    print(",".join(['a','k','s','dist','d_prob']+states),file=f)
+    for g in range(len(grid)):
+      a,k,s,dist = grid[g]
+      print(f1(a)," ",f1(k)," ",f1(s)," ",dist.ljust(7),"   ",f3(d_wins[g]/n_trials))
+      row = [str(a),str(k),str(s),dist,str(d_wins[g]/n_trials)]
+      for j in range(len(states)):
+        row.append(str(state_d_wins[g,j]/n_trials))
+      print(",".join(row),file=f)
+  print(f"Results for each state written to {filename}")
+
+def calibrate(pars,dat,sd,defaults_file,filename):
+  """
+  Fit A, k, and s so that the probabilities of D winning the states, and the election if predictit_nat is given, come as close as
+  possible to the predictit prices, in the sense of least squares. This is done for each dist. Only the states listed in the output
+  are used, so with swing=1, the states that predictit considers safe, whose prices aren't very meaningful, are left out. The probabilities are calculated
+  as with engine=exact, by exact_win_probabilities(), so the loss is a smooth function of the parameters, without any random noise,
+  and each evaluation takes a small fraction of a second. The minimum is found using nelder_mead(), working with log A and log s
+  so that they stay positive. The uncertainties are estimated from the curvature of the loss at the minimum, as for any least-squares
+  fit. Prints the results, and writes the fitted values for the current dist to a file in the same format as defaults.txt.
+  """
+  if np is None:
+    die("calibrate=1 requires the numpy library")
+  states = state_arrays(dat)[0]
+  fitted = listed_states(pars,sd)
+  cols = [states.index(state) for state in fitted]
+  target = [sd['predictit_prob'][state] for state in fitted]
+  if pars['predictit_nat']>0.0:
+    target.append(pars['predictit_nat'])
+  target = np.array(target)
+  def probabilities(a,k,s,dist):
+    d_prob,prob = exact_win_probabilities(parameters_changed(dat,pars['rho'],a,k,s,dist),n_fast_quadrature_nodes())
+    prob = prob[cols]
+    if pars['predictit_nat']>0.0:
+      prob = np.append(prob,d_prob)
+    return prob
+  def loss(a,k,s,dist):
+    return float(((probabilities(a,k,s,dist)-target)**2).sum())
+  fits = {}
+  notes = []
+  print("dist             A              k              s         rms error   evaluations")
+  for dist in ['normal','cauchy']:
+    f = lambda x:loss(math.exp(x[0]),x[1],math.exp(x[2]),dist)
+    x,fx,evals = nelder_mead(f,[math.log(pars['a']),pars['k'],math.log(pars['s'])],[0.3,0.5,0.3],tol=1.0e-4)
+    best = [math.exp(x[0]),x[1],math.exp(x[2])]
+    errors = least_squares_errors(lambda y:loss(y[0],y[1],y[2],dist),best,fx,len(target))
+    if min(best[0],best[2])<0.01:
+      errors = [None]*3 # the best fit is at the edge of the allowed range, where the curvature doesn't mean anything
+      notes.append(f"For dist={dist}, A or s went to zero, so there are no error bars. This can happen with swing=0, since predictit doesn't price safe states realistically.")
+    fits[dist] = best
+    line = dist.ljust(8)
+    for i in range(3):
+      line = line+f"{best[i]:8.2f} +- {f2(errors[i])}"
+    print(line,"   ",f3(math.sqrt(fx/len(target))),"     ",evals)
+  for note in notes:
+    print(note)
+  a,k,s = fits[pars['dist']]
+  prob = probabilities(a,k,s,pars['dist'])
+  print(f"state    predictit   fitted, dist={pars['dist']}")
+  for i in range(len(target)):
+    name = fitted[i] if i<len(fitted) else 'nat'
+    print(ps(name).ljust(8),"",f2(target[i]),"     ",f2(prob[i]))
+  write_defaults(defaults_file,filename,{'a':f"{a:.2f}",'k':f"{k:.2f}",'s':f"{s:.2f}",'dist':pars['dist']})
+  print(f"Fitted values for dist={pars['dist']} written to {filename}, which can be copied to {defaults_file}")
+
+def n_fast_quadrature_nodes():
+  return 64 # number of quadrature nodes used by calibrate() and sensitivity(); gives probabilities to about 10^-7
+
+def parameters_changed(dat,rho,a,k,s,dist):
+  # A copy of dat with different values of A, k, s, and dist. The sizes of the states' own fluctuations are proportional to A*s.
+  result = copy.copy(dat)
+  result['aa'] = math.sqrt(math.pi/2.0)*a
+  (result['k'],result['s'],result['dist']) = (k,s,dist)
+  result['ind'] = state_weights(dat['electoral_votes'],rho)
+  for state in result['ind']:
+    result['ind'][state] *= result['aa']*s
+  return result
+
+def sensitivity(pars,dat,sd,filename):
+  """
+  Estimate how much the results would change in response to a small change in each input: each state's lean and poll, and k, A,
+  and s. A state's lean affects its expected margin both directly and through the calibration factor c, while its poll only
+  affects c. Each derivative is a central difference, with the input moved up and down by the amount in sensitivity_steps().
+  For the probabilities of D winning the election and the states, the results for each change are calculated as with engine=exact,
+  so there are no random errors. (With correlation, where that isn't possible, the trials are used instead.) For the
+  tipping points, a second pass of n_trials trials is done after the main run, with common_random_numbers(), and each trial is
+  redone for every change, so the standard error of each difference can be estimated from how much it varies from trial to trial. Prints a table ranked by the effect of each state's
+  lean on the probability of a D win, and writes all the derivatives to a csv file.
+  """
+  check_array_engine(pars,"sensitivity=1")
+  if dat['tilt']>0.0:
+    die("importance sampling (tilt>0) can't be used with sensitivity")
+  states = state_arrays(dat)[0]
+  n = len(states)
+  steps = sensitivity_steps()
+  inputs = []
+  for state in states:
+    inputs.append(('lean',state))
+    if not (sd['poll'][state] is None):
+      inputs.append(('poll',state))
+  for what in ['k','a','s']:
+    inputs.append((what,None))
+  versions = [] # for each input, dat with the input moved down and up
+  for what,state in inputs:
+    versions.append([perturbed(dat,sd,pars['rho'],what,state,sign*steps[what]) for sign in [-1,1]])
+  exact = dat['cholesky'] is None
+  # Trials with common random numbers. For each input, sums over trials of the change in who won and in each state's being the tipping point,
+  # and of the squares of the changes.
+  seed = resolved_seed(pars)
+  rng = np.random.default_rng(seed)
+  n_trials = pars['n_trials']
+  d_win_diff = np.zeros((len(inputs),2))
+  prob_diff = np.zeros((len(inputs),n))
+  tip_diff = np.zeros((len(inputs),n,2))
+  for start in range(0,n_trials,numpy_chunk_size()):
+    m = min(numpy_chunk_size(),n_trials-start)
+    z0,zz = common_random_numbers(dat,rng,m,n)
+    for i in range(len(inputs)):
+      outcome = []
+      for v in versions[i]:
+        states,ev,ind_v,mu = state_arrays(v)
+        x = bell_to_200_percent_range_array(v['aa']*z0[:,None]+ind_v*zz+mu)
+        state_d_win,d,d_win = election_results(v,x)
+        outcome.append((state_d_win,d_win,tipping_points_array(v['safe_d'],v['safe_r'],x,ev,v['tie'],d_win,2)))
+      (lo,hi) = outcome
+      change = hi[1].astype(np.int64)-lo[1]
+      d_win_diff[i] += [change.sum(),(change*change).sum()]
+      prob_diff[i] += hi[0].sum(axis=0)-lo[0].sum(axis=0)
+      count_lo = np.bincount(lo[2],minlength=n)
+      count_hi = np.bincount(hi[2],minlength=n)
+      count_both = np.bincount(lo[2][lo[2]==hi[2]],minlength=n)
+      tip_diff[i,:,0] += count_hi-count_lo
+      tip_diff[i,:,1] += count_hi+count_lo-2*count_both # sum of squares of the changes, each of which is -1, 0, or 1
+  width = np.array([2.0*steps[what] for what,state in inputs])
+  def derivative(sums):
+    # derivative and its standard error, from the sums of the changes and of their squares
+    mean = sums[...,0]/n_trials
+    var = np.maximum(sums[...,1]/n_trials-mean*mean,0.0)
+    return (mean,np.sqrt(var/n_trials))
+  d_tip,d_tip_se = derivative(tip_diff)
+  d_tip,d_tip_se = (d_tip/width[:,None],d_tip_se/width[:,None])
+  if exact:
+    d_prob_all = []
+    for i in range(len(inputs)):
+      (lo,hi) = [exact_win_probabilities(v,n_fast_quadrature_nodes()) for v in versions[i]]
+      d_prob_all.append(np.concatenate([[hi[0]-lo[0]],hi[1]-lo[1]])/width[i])
+    d_prob_all = np.array(d_prob_all)
+    d_nat,d_nat_se = (d_prob_all[:,0],np.zeros(len(inputs)))
+    d_prob = d_prob_all[:,1:]
+  else:
+    d_nat,d_nat_se = derivative(d_win_diff)
+    d_nat,d_nat_se = (d_nat/width,d_nat_se/width)
+    d_prob = prob_diff/n_trials/width[:,None]
+  row = {}
+  for i in range(len(inputs)):
+    row[inputs[i]] = i
+  print("")
+  print("sensitivity of the results to each input, per unit of lean or percentage point of polls:")
+  print("state    D win/lean  D win/poll  state/lean  tip/lean    +-")
+  ranked = sorted(listed_states(pars,sd),key=lambda state:-abs(d_nat[row[('lean',state)]]))
+  for state in ranked:
+    i = row[('lean',state)]
+    j = states.index(state)
+    d_poll = None
+    if ('poll',state) in row:
+      d_poll = d_nat[row[('poll',state)]]
+    print(ps(state).ljust(8),"",f3(d_nat[i]),"    ",f3(d_poll),"    ",f3(d_prob[i,j]),"    ",f3(d_tip[i,j]),f3(d_tip_se[i,j]))
+  for what in ['k','a','s']:
+    i = row[(what,None)]
+    line = f"D win/{'A' if what=='a' else what}= {f3(d_nat[i])}"
+    if not exact:
+      line = line+" +- "+f3(d_nat_se[i])
+    print(line)
+  with open(filename,'w') as f:
+    print(",".join(['input','state','step','d_prob','d_prob_se']+states+['tip_'+state for state in states]+['tip_se_'+state for state in states]),file=f)
+    for i in range(len(inputs)):
+      what,state = inputs[i]
+      print(",".join([what,state or '',str(steps[what]),str(d_nat[i]),str(d_nat_se[i])]+[str(x) for x in d_prob[i]]
+                     +[str(x) for x in d_tip[i]]+[str(x) for x in d_tip_se[i]]),file=f)
+  print(f"All derivatives written to {filename}")
+
+def scenarios(pars,dat,sd,data_file,filename):
+  """
+  Compare the results for several scenarios, which have different leans for the states, and possibly different polls. The calibration
+  factor c is worked out separately for each scenario from its leans and polls, as in setup(). See scenario_list() for how the scenarios
+  are specified. The first one is always the consensus leans and the actual polls. All the scenarios use the same trials, from
+  common_random_numbers(), and only the expected margins differ, so all the scenarios are done in a single array operation.
+  The standard error of the
+  change from the consensus is estimated from how much it varies from trial to trial. With engine=exact, the probabilities are
+  calculated for each scenario by exact_win_probabilities() instead. Prints a table with a column for each scenario, and writes the
+  results to a csv file.
+  """
+  check_array_engine(pars,"scenarios=...")
+  if dat['tilt']>0.0:
+    die("importance sampling (tilt>0) can't be used with scenarios")
+  scenario_data = scenario_list(pars,sd,data_file)
+  names = [name for name,lean,poll in scenario_data]
+  versions = []
+  for name,lean,poll in scenario_data:
+    v = copy.copy(dat)
+    v['lean'] = lean
+    v['c'] = calibrate_lean_to_percent(poll,lean)[0]
+    versions.append(v)
+  arrays = state_arrays(dat)
+  (states,ind_v) = (arrays[0],arrays[2])
+  mu = np.array([state_arrays(v)[3] for v in versions]) # indices are (scenario,state)
+  n = len(states)
+  n_trials = pars['n_trials']
+  change_se = [None]*len(versions)
+  if pars['engine']=='exact':
+    results = [exact_win_probabilities(v) for v in versions]
+    d_prob = np.array([r[0] for r in results])
+    prob = np.array([r[1] for r in results])
+  else:
+    seed = resolved_seed(pars)
+    rng = np.random.default_rng(seed)
+    d_wins = np.zeros(len(versions))
+    state_d_wins = np.zeros((len(versions),n))
+    n_changed = np.zeros(len(versions)) # number of trials in which the winner was different from the one with the consensus
+    chunk = max(1,numpy_chunk_size()//len(versions)) # the margins for all the scenarios are in memory at once
+    for start in range(0,n_trials,chunk):
+      m = min(chunk,n_trials-start)
+      z0,zz = common_random_numbers(dat,rng,m,n)
+      x = (dat['aa']*z0[:,None]+ind_v*zz)[None,:,:]+mu[:,None,:] # no need to apply bell_to_200_percent_range(), which doesn't change the sign
+      results = election_results(dat,x) # indices are (scenario,trial,state)
+      (state_d_win,d_win) = (results[0],results[2])
+      d_wins += np.count_nonzero(d_win,axis=1)
+      state_d_wins += np.count_nonzero(state_d_win,axis=1)
+      n_changed += np.count_nonzero(d_win!=d_win[0],axis=1)
+    d_prob = d_wins/n_trials
+    prob = state_d_wins/n_trials
+    for g in range(1,len(versions)):
+      # Each trial's change is -1, 0, or 1, so the sum of the squares of the changes is the number of trials in which there was one.
+      mean = d_prob[g]-d_prob[0]
+      change_se[g] = math.sqrt(max(n_changed[g]/n_trials-mean*mean,0.0)/n_trials)
+  print("scenario             c    prob of D win    change     +-")
+  for g in range(len(versions)):
+    print(names[g].ljust(16),f1(versions[g]['c']),"      ",f3(d_prob[g]),"     ",f3(d_prob[g]-d_prob[0]),f3(change_se[g]))
+  print("")
+  print("state   "+"".join([name[:9].rjust(10) for name in names]))
+  for state in listed_states(pars,sd):
+    j = states.index(state)
+    print(ps(state).ljust(8)+"".join([f3(prob[g,j]).rjust(10) for g in range(len(versions))]))
+  with open(filename,'w') as f:
+    print(",".join(['scenario','c','d_prob','change','change_se']+states),file=f)
+    for g in range(len(versions)):
+      print(",".join([names[g],str(versions[g]['c']),str(d_prob[g]),str(d_prob[g]-d_prob[0]),str(change_se[g] or '')]
+                     +[str(p) for p in prob[g]]),file=f)
+  print(f"Results for each state written to {filename}")
+
+def scenario_list(pars,sd,data_file):
+  """
+  The scenarios given by pars['scenarios'], which is a list separated by commas. Each item is either experts, meaning one scenario for
+  each expert's column in the data file, see expert_leans(), or the name of a file of changes to the leans and polls, see
+  read_scenario_file(). Returns a list of (name,lean,poll), starting with the consensus leans and the actual polls.
+  """
+  result = [('consensus',sd['lean'],sd['poll'])]
+  for item in pars['scenarios'].split(','):
+    if item=='experts':
+      for name,lean in expert_leans(data_file,sd['lean']):
+        result.append((name,lean,sd['poll']))
+    else:
+      result.append(read_scenario_file(item,sd))
+  return result
+
+def expert_leans(filename,consensus):
+  """
+  Read the ratings by individual experts, which are in the columns after predictit in data.csv, on the same scale as lean.
+  Returns a list of (name,lean), where the name is the first word of the column's title, e.g., cook, and lean has a value
+  for every state. Where an expert didn't rate a state, the consensus lean is used.
+  """
+  with open(filename,newline='') as csv_file:
+    rows = list(csv.reader(csv_file))
+  titles = rows[0]
+  result = []
+  for col in range(4,len(titles)):
+    name = re.sub('[^a-z]','',(titles[col].split() or [''])[0].lower()) or f"column{col+1}"
+    lean = dict(consensus)
+    for row in rows[1:]:
+      if len(row)>col and row[col].strip()!='' and row[0] in lean:
+        lean[row[0]] = float(row[col])
+    result.append((name,lean))
+  if len(result)==0:
+    die(f"{filename} doesn't have any columns of experts' ratings")
+  return result
+
+def read_scenario_file(filename,sd):
+  """
+  Read a file of changes to the leans and polls of some of the states, e.g.,
+    state,lean,poll
+    pa,1,
+    fl,,-2.5
+  where a blank means that the value isn't changed. The scenario is named after the file. Returns (name,lean,poll).
+  """
+  (lean,poll) = (dict(sd['lean']),dict(sd['poll']))
+  try:
+    csv_file = open(filename,newline='')
+  except OSError:
+    die(f"can't read the scenario file {filename}")
+  with csv_file:
+    csv_reader = csv.reader(csv_file)
+    next(csv_reader) # titles
+    for row in csv_reader:
+      if len(row)==0:
+        continue
+      state = row[0].strip().lower()
+      if not (state in lean):
+        die(f"{state} in {filename} isn't one of the states in data.csv")
+      if len(row)>1 and row[1].strip()!='':
+        lean[state] = float(row[1])
+      if len(row)>2 and row[2].strip()!='':
+        poll[state] = float(row[2])
+  return (os.path.splitext(os.path.basename(filename))[0],lean,poll)
+
+def sensitivity_steps():
+  # How much each input is moved up and down by sensitivity(). For tipping points, smaller steps give noisier results.
+  return {'lean':0.25,'poll':1.0,'k':0.25,'a':0.25,'s':0.1}
+
+def perturbed(dat,sd,rho,what,state,h):
+  """
+  A copy of dat with one input changed by h: the lean or poll of a state (either of which changes the calibration factor c), or k, A,
+  or s.
+  """
+  if what in ['lean','poll']:
+    (lean,poll) = (dict(sd['lean']),dict(sd['poll']))
+    if what=='lean':
+      lean[state] += h
+    else:
+      poll[state] += h
+    result = copy.copy(dat)
+    result['lean'] = lean
+    result['c'] = calibrate_lean_to_percent(poll,lean)[0]
+    return result
+  (a,k,s) = (dat['aa']/math.sqrt(math.pi/2.0),dat['k'],dat['s'])
+  if what=='k':
+    k += h
+  elif what=='a':
+    a += h
+  else:
+    s += h
+  return parameters_changed(dat,rho,a,k,s,dat['dist'])
+
+def nelder_mead(f,x0,step,tol=1.0e-6,max_evals=2000):
+  """
+  Minimize the function f of a list of numbers, starting from the point x0, using the Nelder-Mead downhill simplex method. The
+  initial simplex has x0 and the points displaced from it by step[i] along each axis. Stops when the points of the simplex
+  are all within tol of the best one, along every axis, or after max_evals evaluations. Returns (x,f(x),number of evaluations).
+  """
+  n = len(x0)
+  simplex = [list(x0)]
+  for i in range(n):
+    x = list(x0)
+    x[i] += step[i]
+    simplex.append(x)
+  values = [f(x) for x in simplex]
+  evals = n+1
+  def toward(x,y,t):
+    # the point x+t(y-x)
+    return [x[i]+t*(y[i]-x[i]) for i in range(n)]
+  while evals<max_evals:
+    order = sorted(range(n+1),key=lambda j:values[j])
+    simplex = [simplex[j] for j in order]
+    values = [values[j] for j in order]
+    if max([abs(simplex[j][i]-simplex[0][i]) for j in range(1,n+1) for i in range(n)])<tol:
+      break
+    centroid = [sum([simplex[j][i] for j in range(n)])/n for i in range(n)] # of all but the worst point
+    reflected = toward(centroid,simplex[n],-1.0)
+    fr = f(reflected)
+    evals += 1
+    if fr<values[0]:
+      expanded = toward(centroid,simplex[n],-2.0)
+      fe = f(expanded)
+      evals += 1
+      if fe<fr:
+        simplex[n],values[n] = (expanded,fe)
+      else:
+        simplex[n],values[n] = (reflected,fr)
+    elif fr<values[n-1]:
+      simplex[n],values[n] = (reflected,fr)
+    else:
+      if fr<values[n]:
+        contracted = toward(centroid,reflected,0.5)
+      else:
+        contracted = toward(centroid,simplex[n],0.5)
+      fc = f(contracted)
+      evals += 1
+      if fc<min(fr,values[n]):
+        simplex[n],values[n] = (contracted,fc)
+      else:
+        for j in range(1,n+1): # shrink toward the best point
+          simplex[j] = toward(simplex[0],simplex[j],0.5)
+          values[j] = f(simplex[j])
+        evals += n
+  best = min(range(n+1),key=lambda j:values[j])
+  return (simplex[best],values[best],evals)
+
+def least_squares_errors(f,x,fx,n_data):
+  """
+  Standard errors of the parameters x that minimize f, a sum of n_data squared residuals, whose value at x is fx. The Hessian
+  matrix H of f is found by finite differences, and then the covariance matrix is 2 sigma^2 H^-1, where the variance of each
+  residual, sigma^2, is estimated as fx/(n_data-number of parameters). Returns a list with None for any parameter whose error
+  can't be estimated, because the minimum isn't well defined.
+  """
+  n = len(x)
+  if n_data<=n:
+    return [None]*n
+  h = [1.0e-3*max(abs(x[i]),1.0) for i in range(n)]
+  def at(steps):
+    return f([x[i]+steps[i]*h[i] for i in range(n)])
+  hessian = np.zeros((n,n))
+  for i in range(n):
+    for j in range(i,n):
+      e = [[0]*n for q in range(4)]
+      e[0][i] += 1
+      e[0][j] += 1
+      e[1][i] += 1
+      e[1][j] -= 1
+      e[2][i] -= 1
+      e[2][j] += 1
+      e[3][i] -= 1
+      e[3][j] -= 1
+      hessian[i,j] = (at(e[0])-at(e[1])-at(e[2])+at(e[3]))/(4.0*h[i]*h[j])
+      hessian[j,i] = hessian[i,j]
+  try:
+    cov = 2.0*fx/(n_data-n)*np.linalg.inv(hessian)
+  except np.linalg.LinAlgError:
+    return [None]*n
+  return [math.sqrt(cov[i,i]) if cov[i,i]>0.0 else None for i in range(n)]
+
+def write_defaults(defaults_file,filename,values):
+  # Write a copy of defaults_file with the parameters in values changed, or added at the top if they weren't there.
+  lines = []
+  with open(defaults_file) as f:
+    for line in f:
+      capture = re.search("^(.*)=(.*)$",line.strip())
+      if capture and capture.group(1) in values:
+        continue
+      lines.append(line.rstrip('\n'))
+  with open(filename,'w') as f:
+    for p in values:
+      print(f"{p}={values[p]}",file=f)
+    for line in lines:
+      print(line,file=f)
+
+def pair_matrices(pars,dat,sd,filename):
+  """
+  Joint probabilities for every pair of states, and for every state paired with the national result, all from one run. Let the
+  matrix S have a row for each trial and a column for each state plus one for nat, with 1 where D won. Then S^T S, added up
+  over chunks of trials, counts the trials in which D won both members of each pair. With importance sampling, the rows are
+  weighted. With engine=exact, the same matrix is built up from the probabilities for each value of the national shock,
+  for which the states are independent. Prints the probability of a D win conditioned on each state, and writes
+  all the matrices to a JSON file.
+  """
+  check_array_engine(pars,"pairs=1")
+  states = state_arrays(dat)[0]
+  n = len(states)
+  if pars['engine']=='exact':
+    given_pop = exact_given_pop(dat)
+    (w,p,d_win,r_state) = (given_pop[1],given_pop[3],given_pop[4],given_pop[5])
+    both = (p*w[:,None]).T@p # for two different states, the probabilities multiply once pop is fixed
+    d_state_d_nat = w@(p-r_state)
+    both = np.block([[both,d_state_d_nat[:,None]],[d_state_d_nat[None,:],np.array([[w@d_win]])]])
+    both[np.arange(n),np.arange(n)] = w@p # a state's joint probability with itself is just its probability
+    n_trials = None
+  else:
+    seed = resolved_seed(pars)
+    rng = np.random.default_rng(seed)
+    n_trials = pars['n_trials']
+    both = np.zeros((n+1,n+1))
+    total = 0.0
+    for start in range(0,n_trials,numpy_chunk_size()):
+      m = min(numpy_chunk_size(),n_trials-start)
+      x,wt = draw_margins(dat,rng,m)
+      results = election_results(dat,x)
+      (state_d_win,d_win) = (results[0],results[2])
+      won = np.concatenate([state_d_win,d_win[:,None]],axis=1).astype(np.float64)
+      if wt is None:
+        both += won.T@won
+        total += m
+      else:
+        both += (won*wt[:,None]).T@won
+        total += wt.sum()
+    both = both/total
+  prob = np.diag(both).copy()
+  with np.errstate(divide='ignore',invalid='ignore'):
+    given = both/prob[None,:] # given[i,j] = prob that D wins i, given that D wins j
+    given_r = (prob[:,None]-both)/(1.0-prob[None,:]) # given_r[i,j] = prob that D wins i, given that R wins j
+  names = states+['nat']
+  print("state    prob    D win given D wins state    D win given R wins state")
+  for state in listed_states(pars,sd):
+    j = states.index(state)
+    print(ps(state).ljust(7),f2(prob[j]),"             ",f2(nan_to_none(given[n,j])),
+              "                      ",f2(nan_to_none(given_r[n,j])))
+  def matrix(x):
+    return [[nan_to_none(x[i,j]) for j in range(n+1)] for i in range(n+1)]
+  with open(filename,'w') as f:
+    json.dump({'names':names,'n_trials':n_trials,'engine':pars['engine'],'prob':[float(x) for x in prob],
+               'both':matrix(both),'given':matrix(given),'given_r':matrix(given_r),
+               'notes':['both[i][j] is the probability that D wins both i and j',
+                        'given[i][j] is the probability that D wins i, given that D wins j',
+                        'given_r[i][j] is the probability that D wins i, given that R wins j']},f)
+  print(f"All pairs of states written to {filename}")
+
+def nan_to_none(x):
+  # For writing out conditional probabilities where the condition never happened.
+  if math.isnan(x) or math.isinf(x):
+    return None
+  return float(x)
+
+def timeline(pars,dat,sd,filename):
+  """
+  Redo the forecast as it would have come out on every date in a range, such as 8/1/20:11/3/20 (optionally followed by :step,
+  a number of days). The only thing that depends on the date is A, from guess_national_variability(). All the dates
+  use the same trials, from common_random_numbers(), so the changes from one date to the next are smooth rather than noisy. If timeline_polls is given, it's a file of poll averages for each date, written
+  by polls.py, and the calibration factor c is also recalculated for each date. If workers>1, the dates are split up among worker
+  processes, each of which draws the same random numbers from the same seed, so the results don't depend on the number of
+  workers. With engine=exact, each date is calculated exactly, without tipping points. Writes d_prob, and each state's probability
+  and tipping-point probability, to a csv file with one row per date.
+  """
+  check_array_engine(pars,"timeline=...")
+  if dat['tilt']>0.0:
+    die("importance sampling (tilt>0) can't be used with timeline")
+  dates = parse_timeline(pars['timeline'])
+  dated_polls = None
+  if pars['timeline_polls']!='':
+    dated_polls = read_timeline_polls(pars['timeline_polls'],dat['lean'])
+  dat_by_date = [dat_for_date(dat,date,dated_polls) for date in dates]
+  a = [guess_national_variability(date) for date in dates]
+  states = state_arrays(dat)[0]
+  n = len(states)
+  if pars['engine']=='exact':
+    d_prob = np.zeros(len(dates))
+    prob = np.zeros((len(dates),n))
+    for g in range(len(dates)):
+      given_pop = exact_given_pop(dat_by_date[g])
+      (w,p,d_win) = (given_pop[1],given_pop[3],given_pop[4])
+      d_prob[g] = w@d_win
+      prob[g] = w@p
+    tipping = None
+  else:
+    seed = resolved_seed(pars)
+    workers = max(1,min(pars['workers'],len(dates)))
+    groups = [list(range(len(dates)))[i::workers] for i in range(workers)]
+    tasks = [(dat,[dat_by_date[g] for g in group],pars['n_trials'],seed) for group in groups]
+    if workers>1:
+      with multiprocessing.Pool(workers) as pool:
+        parts = pool.map(timeline_trials,tasks)
+    else:
+      parts = map(timeline_trials,tasks)
+    d_prob = np.zeros(len(dates))
+    prob = np.zeros((len(dates),n))
+    tipping = np.zeros((len(dates),n))
+    for group,part in zip(groups,parts):
+      d_prob[group],prob[group],tipping[group] = part
+  print("  date      A      c    prob of D win")
+  with open(filename,'w') as f:
+    print(",".join(['date','a','c','d_prob']+states+['tip_'+state for state in states]),file=f)
+    for g in range(len(dates)):
+      date = dates[g].strftime('%m/%d/%y')
+      c = dat_by_date[g]['c']
+      print(date.rjust(8),f1(a[g]),f1(c),"   ",f3(d_prob[g]))
+      row = [date,str(a[g]),str(c),str(d_prob[g])]+[str(x) for x in prob[g]]
+      if tipping is None:
+        row = row+['']*n
+      else:
+        row = row+[str(x) for x in tipping[g]]
+      print(",".join(row),file=f)
+  print(f"Results for each date written to {filename}")
+
+def parse_timeline(v):
+  # Parse a range of dates like 8/1/20:11/3/20 or 8/1/20:11/3/20:7 into a list of datetimes.
+  parts = v.split(':')
+  if not (len(parts) in [2,3]):
+    die(f"timeline should be a range of dates like 8/1/20:11/3/20, or 8/1/20:11/3/20:7 to do every 7th day, not {v}")
+  try:
+    first,last = [datetime.datetime.strptime(x,'%m/%d/%y') for x in parts[:2]]
+  except ValueError:
+    die(f"dates in timeline should be in the format 8/1/20, not {v}")
+  step = 1
+  if len(parts)==3:
+    step = int(parts[2])
+  if step<=0 or last<first:
+    die(f"empty range of dates in timeline {v}")
+  return [first+datetime.timedelta(days=d) for d in range(0,(last-first).days+1,step)]
+
+def read_timeline_polls(filename,lean):
+  """
+  Read a file written by polls.py timeline=..., with lines of the form date,state,poll,undecided. Returns a dict whose keys are
+  dates and whose values are dicts giving the average poll for each state in data.csv, or None if there were no recent polls.
+  """
+  result = {}
+  with open(filename,newline='') as csv_file:
+    csv_reader = csv.reader(csv_file)
+    next(csv_reader) # titles
+    for row in csv_reader:
+      date = datetime.datetime.strptime(row[0],'%m/%d/%y')
+      if not (date in result):
+        result[date] = {}
+        for state in lean:
+          result[date][state] = None
+      state = row[1]
+      if state in lean:
+        result[date][state] = float(row[2])
+  return result
+
+def dat_for_date(dat,date,dated_polls):
+  # A copy of dat with the inputs that depend on the date changed: A, and, if we have polls for each date, c.
+  result = rescale_national_variability(dat,guess_national_variability(date))
+  if not (dated_polls is None):
+    if not (date in dated_polls):
+      die(f"no polls for {date.strftime('%m/%d/%y')} in timeline_polls")
+    result['c'] = calibrate_lean_to_percent(dated_polls[date],dat['lean'])[0]
+  return result
+
+def rescale_national_variability(dat,a):
+  # A copy of dat, with A changed to a. The states' own fluctuations are proportional to A, so they're rescaled as well.
+  result = copy.copy(dat)
+  result['aa'] = math.sqrt(math.pi/2.0)*a
+  result['ind'] = {}
+  for state in dat['ind']:
+    result['ind'][state] = dat['ind'][state]*result['aa']/dat['aa']
+  return result
+
+def timeline_trials(task):
+  """
+  Helper for timeline(), which does all the trials for a list of dates, each with its own version of dat. For each chunk of trials,
+  the random numbers from common_random_numbers() are used for every date. Returns arrays with the
+  probability of a D win, and each state's probability of going D and of being the tipping point, with one row for each date.
+  """
+  dat,dat_list,n_trials,seed = task
+  (safe_d,safe_r,tie) = (dat['safe_d'],dat['safe_r'],dat['tie'])
+  states,ev,ind_v,mu = state_arrays(dat)
+  n = len(states)
+  rng = np.random.default_rng(seed)
+  d_wins = np.zeros(len(dat_list))
+  state_d_wins = np.zeros((len(dat_list),n))
+  tipping = np.zeros((len(dat_list),n))
+  for start in range(0,n_trials,numpy_chunk_size()):
+    m = min(numpy_chunk_size(),n_trials-start)
+    z0,zz = common_random_numbers(dat,rng,m,n)
+    for g in range(len(dat_list)):
+      states,ev,ind_v,mu = state_arrays(dat_list[g])
+      x = bell_to_200_percent_range_array(dat_list[g]['aa']*z0[:,None]+ind_v*zz+mu)
+      results = election_results(dat,x)
+      (state_d_win,d_win) = (results[0],results[2])
+      d_wins[g] += np.count_nonzero(d_win)
+      state_d_wins[g] += np.count_nonzero(state_d_win,axis=0)
+      tipping[g] += np.bincount(tipping_points_array(safe_d,safe_r,x,ev,tie,d_win,2),minlength=n)
+  return (d_wins/n_trials,state_d_wins/n_trials,tipping/n_trials)
+
+def engine_version():
+  return 2 # Increment this whenever a change to the code would change the results, so that old results in the cache aren't used.
+
+def cache_directory():
+  return 'cache'
+
+def cache_max_bytes():
+  return 50*1024*1024 # when the cache gets bigger than this, the least recently used results are thrown away
+
+def is_cacheable(pars):
+  """
+  Whether main() reads and writes the cache. Without a seed, every run is supposed to get new random numbers, so only seeded
+  runs and engine=exact, which has no random numbers, are cached. A checkpoint can be extended, so its results aren't cached either.
+  """
+  return pars['cache']==1 and pars['checkpoint']=='' and (pars['seed']!=0 or pars['engine']=='exact')
+
+def cache_key(pars,input_files):
+  """
+  A hash that identifies the results of a run. It depends on all the parameters (including a, which depends on the date,
+  and the random seed), the contents of the input files, and the engine version, but not on the ones in
+  parameters_not_in_cache_key(), which don't affect the results.
+  """
+  h = hashlib.sha256()
+  p = {}
+  for key in pars:
+    if not (key in parameters_not_in_cache_key()):
+      p[key] = pars[key]
+  h.update(json.dumps({'pars':p,'engine_version':engine_version()},sort_keys=True).encode('utf-8'))
+  for filename in input_files:
+    with open(filename,'rb') as f:
+      h.update(hashlib.sha256(f.read()).digest())
+  return h.hexdigest()
+
+def parameters_not_in_cache_key():
+  return ['workers','cache','profile','profile_json','sensitivity']
+
+def read_cache(key):
+  # Returns the accumulated totals stored under this key, or None if they're not in the cache.
+  filename = os.path.join(cache_directory(),key+'.json')
+  try:
+    with open(filename) as f:
+      acc = json.load(f)
+  except (OSError,ValueError):
+    return None
+  os.utime(filename) # mark as recently used
+  return acc
+
+def write_cache(key,acc):
+  os.makedirs(cache_directory(),exist_ok=True)
+  filename = os.path.join(cache_directory(),key+'.json')
+  temp = filename+'.'+str(os.getpid())
+  with open(temp,'w') as f:
+    json.dump(acc,f)
+  os.replace(temp,filename) # so that another process never sees a half-written file
+  evict_from_cache(cache_max_bytes())
+
+def evict_from_cache(max_bytes):
+  # Delete the least recently used results until the total size is no more than max_bytes.
+  entries = []
+  for name in os.listdir(cache_directory()):
+    if name.endswith('.json'):
+      filename = os.path.join(cache_directory(),name)
+      try:
+        st = os.stat(filename)
+      except OSError:
+        continue
+      entries.append((st.st_mtime,st.st_size,filename))
+  entries.sort()
+  total = sum([e[1] for e in entries])
+  for mtime,size,filename in entries:
+    if total<=max_bytes:
+      break
+    try:
+      os.remove(filename)
+    except OSError:
+      pass
+    total -= size
+
+def new_accumulators(electoral_votes):
+  """
+  Running totals that are built up over the trials. Everything is a count except vote_sum, which is the
+  sum of the simulated margins. The histograms have a fixed size, no matter how many trials there are: ev_histogram counts the
+  trials in which D got each number of electoral votes from 0 to 538, and margin_histogram counts, for each state, the trials
+  in which D's margin fell in each of n_margin_bins() equal bins from -100% to 100%. With importance sampling, the counts
+  are sums of weights, and sq holds the sums of squared weights. If there are senate or house races, races holds the totals for them,
+  see new_race_accumulators(). With variance reduction (sampling other than plain), replicates holds some of the totals
+  separately for each block of trials, see replicate_totals().
+  """
+  acc = {'n':0,'sq':None,'d_wins':0,'state_d_wins':{},'rcl':{},'vote_sum':{},'joint_table':[[0,0],[0,0]],
+         'ev_histogram':[0]*(electoral_college_size()+1),'margin_histogram':{},'tipping_histogram':{},'races':None,'replicates':None}
   for state in electoral_votes:
-    ind[state] *= (aa*s)
+    acc['state_d_wins'][state] = 0
+    acc['rcl'][state] = 0 # republican win conditioned on losing this state; at this stage it's just a count
+    acc['vote_sum'][state] = 0.0
+    acc['tipping_histogram'][state] = 0
+    acc['margin_histogram'][state] = new_margin_histogram()
+  return acc
+
+def new_margin_histogram():
+  # A histogram of one state's margin, see new_accumulators(). This is a numpy array if numpy is available, so that adding them up is fast.
+  if np is None:
+    return [0]*n_margin_bins()
+  return np.zeros(n_margin_bins(),dtype=np.int64)
+
+def margin_histogram_array(x,wt=None):
+  # Histograms of the margins x, with one row per trial and one column per state, as an array with one row per state.
+  n = x.shape[1]
+  bins = np.minimum(((x+100.0)/margin_bin_width()).astype(np.int64),n_margin_bins()-1)+n_margin_bins()*np.arange(n)
+  return np.bincount(bins.ravel(),weights=(None if wt is None else np.repeat(wt,n)),
+                     minlength=n*n_margin_bins()).reshape(n,n_margin_bins())
+
+def accumulators_to_json(acc):
+  # A copy of acc that can be saved as json, with the histograms of the margins converted to lists.
+  result = dict(acc)
+  result['margin_histogram'] = {}
+  for state in acc['margin_histogram']:
+    h = acc['margin_histogram'][state]
+    result['margin_histogram'][state] = (h if isinstance(h,list) else h.tolist())
+  return result
+
+def accumulators_from_json(acc):
+  # Undoes accumulators_to_json().
+  if not (np is None):
+    for state in acc['margin_histogram']:
+      acc['margin_histogram'][state] = np.array(acc['margin_histogram'][state])
+  return acc
+
+def new_race_accumulators(races):
+  """
+  Running totals for the races from race_data(): the number of trials in which D won each race, the number in which D
+  controlled each chamber, the sum of D's seats in each chamber, and the number of trials with each combination of outcomes
+  for the presidency and the chambers, see race_outcome_index().
+  """
+  acc = {'race_d_wins':{},'control':{},'seat_sum':{},'outcomes':[0]*2**(len(races['chambers'])+1)}
+  for race in races['seats']:
+    acc['race_d_wins'][race] = 0
+  for chamber in races['chambers']:
+    acc['control'][chamber] = 0
+    acc['seat_sum'][chamber] = 0
+  return acc
+
+def replicate_totals(acc):
+  """
+  The totals needed for error bars, for a single block of trials, as lists that merge_accumulators() joins together, so that
+  there is one element for each block. With variance reduction, the trials within a block aren't independent, but the blocks
+  are, since each one gets its own random number generator, so the error bars are estimated from how much the blocks differ from
+  one another, see replicate_error().
+  """
+  rep = {'n':[acc['n']],'d_wins':[acc['d_wins']],'state_d_wins':{},'rcl':{}}
+  for state in acc['state_d_wins']:
+    rep['state_d_wins'][state] = [acc['state_d_wins'][state]]
+    rep['rcl'][state] = [acc['rcl'][state]]
+  return rep
+
+def new_squared_weights(electoral_votes):
+  # Sums of squares of weights, used for error bars when doing importance sampling; see run_trials_numpy().
+  sq = {'d_wins':0.0,'state_d_wins':{},'rcl':{}}
+  for state in electoral_votes:
+    sq['state_d_wins'][state] = 0.0
+    sq['rcl'][state] = 0.0
+  return sq
 
+def merge_accumulators(acc,part):
+  """
+  Add the totals in part into acc. Everything is a sum over trials, so the result is the same as if all the
+  trials had been done in one run.
+  """
+  acc['n'] += part['n']
+  acc['d_wins'] += part['d_wins']
+  if not (part['sq'] is None):
+    if acc['sq'] is None:
+      acc['sq'] = new_squared_weights(part['rcl'])
+    acc['sq']['d_wins'] += part['sq']['d_wins']
+    for key in ['state_d_wins','rcl']:
+      for state in part['sq'][key]:
+        acc['sq'][key][state] += part['sq'][key][state]
+  for key in ['state_d_wins','rcl','vote_sum','tipping_histogram']:
+    for state in part[key]:
+      acc[key][state] += part[key][state]
+  for i in range(2):
+    for j in range(2):
+      acc['joint_table'][i][j] += part['joint_table'][i][j]
+  for e in range(electoral_college_size()+1):
+    acc['ev_histogram'][e] += part['ev_histogram'][e]
+  for state in part['margin_histogram']:
+    if np is None:
+      for b in range(n_margin_bins()):
+        acc['margin_histogram'][state][b] += part['margin_histogram'][state][b]
+    else:
+      acc['margin_histogram'][state] = acc['margin_histogram'][state]+part['margin_histogram'][state] # the sum is float if there are weights
+  if not (part['races'] is None):
+    if acc['races'] is None:
+      acc['races'] = copy.deepcopy(part['races'])
+    else:
+      for key in ['race_d_wins','control','seat_sum']:
+        for x in part['races'][key]:
+          acc['races'][key][x] += part['races'][key][x]
+      for i in range(len(part['races']['outcomes'])):
+        acc['races']['outcomes'][i] += part['races']['outcomes'][i]
+  if not (part['replicates'] is None):
+    if acc['replicates'] is None:
+      acc['replicates'] = copy.deepcopy(part['replicates'])
+    else:
+      for key in ['n','d_wins']:
+        acc['replicates'][key] += part['replicates'][key]
+      for key in ['state_d_wins','rcl']:
+        for state in part['replicates'][key]:
+          acc['replicates'][key][state] += part['replicates'][key][state]
+  return acc
+
+def run_trials(pars,dat,n_trials,joint,first_block=0):
+  """
+  Do n_trials trials and return the accumulated totals. The trials are split up into blocks of a fixed size,
+  and each block gets its own random number generator, seeded using the seed parameter and the block's index.
+  The blocks are farmed out to a pool of worker processes if workers>1. Since the way the trials are split into
+  blocks doesn't depend on the number of workers, and the blocks are merged in order, a run with a given seed
+  gives the same results regardless of the number of workers. If this is a continuation of an earlier run,
+  first_block is the number of blocks already done, so that the new trials get different random numbers.
+  """
+  acc = new_accumulators(dat['electoral_votes'])
+  for part in run_blocks(pars,dat,n_trials,joint,first_block):
+    merge_accumulators(acc,part)
+  return acc
+
+def run_blocks(pars,dat,n_trials,joint,first_block=0):
+  # Generates the totals for each block of trials done by run_trials(), in order, as soon as each one is available.
+  engine,workers,sampling = (pars['engine'],pars['workers'],pars['sampling'])
+  check_engine(pars,dat)
+  seed = resolved_seed(pars)
+  block = trial_block_size(sampling)
+  tasks = []
+  for b in range(math.ceil(n_trials/block)):
+    m = min(block,n_trials-b*block)
+    tasks.append((engine,dat,m,joint,seed,first_block+b))
+  if workers>1 and len(tasks)>1:
+    with multiprocessing.Pool(min(workers,len(tasks))) as pool:
+      yield from pool.imap(run_block,tasks)
+  else:
+    yield from map(run_block,tasks)
+
+def check_engine(pars,dat):
+  # Make sure that the engine can do trials with these parameters.
+  engine,sampling = (pars['engine'],pars['sampling'])
+  if not (engine in engines()) or engine=='exact':
+    die(f"illegal engine={engine} in run_trials, should be one of {engines()[:2]}")
+  if not (sampling in sampling_schemes()):
+    die(f"illegal sampling={sampling}, should be one of {sampling_schemes()}")
+  if engine=='python' and dat['tilt']>0.0:
+    die("importance sampling (tilt>0) requires engine=numpy")
+  if engine=='python' and sampling!='plain':
+    die(f"sampling={sampling} requires engine=numpy")
+  if engine=='python' and not (dat['cholesky'] is None):
+    die("correlation requires engine=numpy")
+  if engine=='python' and not (dat['races'] is None):
+    die("races requires engine=numpy")
+  if engine=='numpy' and np is None:
+    die("engine=numpy requires the numpy library")
+
+def check_array_engine(pars,what,exact_ok=True):
+  # Make sure that the engine can be used for one of the things that are done with numpy arrays, such as a parameter sweep.
+  engine = pars['engine']
+  allowed = ['numpy','exact'] if exact_ok else ['numpy']
+  if not (engine in allowed):
+    die(f"{what} requires engine={' or '.join(allowed)}, not {engine}")
+  if np is None:
+    die(f"{what} requires the numpy library")
+
+def resolved_seed(pars):
+  # The seed for a run: the seed parameter, or if it's 0, a random one, so that the run isn't reproducible.
+  seed = pars['seed']
+  if seed==0:
+    seed = random.SystemRandom().randrange(1,2**31)
+  return seed
+
+def run_with_checkpoints(pars,dat,joint,filename):
+  """
+  Does the same thing as run_trials(), but every checkpoint_interval() seconds, the totals so far are saved in filename,
+  so that if a long run is interrupted, running the same command again picks up where it left off. Only whole blocks
+  of trials (see trial_block_size()) are saved, along with the random seed, which is chosen and saved the first time if seed=0.
+  With extend=N, N more trials are added to the run that was saved, and the result is exactly the same as for a single run with
+  all the trials, since the blocks get the same random numbers and are merged in the same order. The total that an extension is
+  working toward is saved as extend_target until it's finished, so that if it's interrupted, repeating the same command resumes it
+  rather than adding N more trials again. A partial block at the end is simply redone. The file also has a hash of the parameters and input files, and is refused if they've changed, rather than mixing
+  trials done with different inputs.
+  """
+  if pars['engine']=='exact' or pars['se']>0.0:
+    die("checkpoint can't be used with engine=exact or se>0")
+  cp = read_checkpoint(pars,filename)
+  if cp is None:
+    if pars['extend']>0:
+      die(f"extend requires an existing checkpoint, but {filename} wasn't found")
+    seed = resolved_seed(pars)
+    cp = {'key':checkpoint_key(pars),'seed':seed,'n_trials':0,'blocks':0,'acc':new_accumulators(dat['electoral_votes'])}
+  if pars['extend']>0:
+    if 'extend_target' in cp: # an extension that was interrupted
+      if cp['extend']!=pars['extend']:
+        die(f"the checkpoint {filename} has an unfinished extension, extend={cp['extend']}, which has to be finished first")
+    else:
+      (cp['extend'],cp['extend_target']) = (pars['extend'],cp['n_trials']+pars['extend'])
+    cp['n_trials'] = cp['extend_target']
+  else:
+    cp['n_trials'] = pars['n_trials']
+    cp.pop('extend_target',None)
+  block = trial_block_size(pars['sampling'])
+  n_blocks = cp['n_trials']//block
+  if cp['blocks']>n_blocks:
+    die(f"the checkpoint {filename} already has {cp['blocks']*block} trials, more than n_trials={cp['n_trials']}")
+  p = dict(pars)
+  p['seed'] = cp['seed']
+  saved = time.time()
+  for part in run_blocks(p,dat,(n_blocks-cp['blocks'])*block,joint,cp['blocks']):
+    merge_accumulators(cp['acc'],part)
+    cp['blocks'] += 1
+    if time.time()-saved>checkpoint_interval():
+      write_checkpoint(filename,cp)
+      saved = time.time()
+  cp.pop('extend_target',None) # finished, so a repeated extend=N adds N more
+  write_checkpoint(filename,cp)
+  acc = copy.deepcopy(cp['acc'])
+  if cp['n_trials']>n_blocks*block:
+    merge_accumulators(acc,run_trials(p,dat,cp['n_trials']-n_blocks*block,joint,first_block=n_blocks))
+  return acc
+
+def checkpoint_interval():
+  return 60 # seconds between saves of the checkpoint file
+
+def checkpoint_key(pars):
+  # The same as cache_key(), but leaving out the parameters that can differ among the runs that build up one set of trials.
+  p = dict(pars)
+  for key in ['n_trials','extend','checkpoint','replay','seed']:
+    p[key] = None
+  return cache_key(p,input_files(pars))
+
+def read_checkpoint(pars,filename):
+  # Returns the contents of the checkpoint file, or None if there isn't one. The seed is saved separately from the hash of the parameters,
+  # so that it doesn't have to be given again, but if it is given, it has to be the same one.
+  try:
+    with open(filename) as f:
+      cp = json.load(f)
+  except OSError:
+    return None
+  except ValueError:
+    die(f"the checkpoint {filename} can't be read")
+  if cp['key']!=checkpoint_key(pars):
+    die(f"the checkpoint {filename} was made with different parameters or input files")
+  if pars['seed']!=0 and pars['seed']!=cp['seed']:
+    die(f"the checkpoint {filename} was made with seed={cp['seed']}")
+  cp['acc'] = accumulators_from_json(cp['acc'])
+  return cp
+
+def write_checkpoint(filename,cp):
+  temp = filename+'.temp'
+  with open(temp,'w') as f:
+    json.dump(dict(cp,acc=accumulators_to_json(cp['acc'])),f)
+  os.replace(temp,filename) # so that an interruption while writing doesn't destroy the previous checkpoint
+
+def replay_trial(pars,dat,i):
+  """
+  Print the details of trial number i, counting from 1, of the run with the given seed and n_trials, or of the run saved in
+  the checkpoint file, if there is one. Trial i is trial (i-1)%B of block (i-1)//B, where B is the number of trials in a block, and
+  the random numbers for a block depend only on the seed and the block's index, so only that one block has to be redone.
+  """
+  check_engine(pars,dat)
+  (seed,n_trials) = (pars['seed'],pars['n_trials'])
+  if pars['checkpoint']!='':
+    cp = read_checkpoint(pars,pars['checkpoint'])
+    if cp is None:
+      die(f"the checkpoint {pars['checkpoint']} wasn't found")
+    (seed,n_trials) = (cp['seed'],cp['n_trials'])
+  if seed==0:
+    die("replay requires a seed, or a checkpoint, since otherwise the random numbers are different on every run")
+  if i>n_trials:
+    die(f"replay={i} is more than the number of trials, {n_trials}")
+  block = trial_block_size(pars['sampling'])
+  b,r = divmod(i-1,block)
+  m = min(block,n_trials-b*block)
+  (y,wt) = (None,None)
+  if pars['engine']=='python':
+    units = unit_lists(dat)
+    states = units[0]
+    rng = random.Random(f"{seed},{b}")
+    for j in range(r+1):
+      x,d,d_win,tip = one_trial(dat,units,rng)
+  else:
+    states = state_arrays(dat)[0]
+    rng = np.random.default_rng([seed,b])
+    for start in range(0,m,numpy_chunk_size()): # the same chunks as in run_trials_numpy()
+      xx,yy,ww = draw_all_margins(dat,rng,min(numpy_chunk_size(),m-start))
+      if r<start+len(xx):
+        break
+    x = xx[r-start:r-start+1]
+    state_d_win,dd,dw = election_results(dat,x)
+    tip = tipping_points_array(dat['safe_d'],dat['safe_r'],x,state_arrays(dat)[1],dat['tie'],dw,2)[0]
+    (x,d,d_win) = (x[0].tolist(),dd[0].item(),int(dw[0]))
+    if not (yy is None):
+      y = yy[r-start:r-start+1]
+      race_d_win,seats,control = race_results(dat,y,dw)
+    if not (ww is None):
+      wt = ww[r-start].item()
+  print(f"trial {i} of {n_trials}, seed={seed}, block {b}, trial {r} in the block")
+  print("state    margin")
+  for j in range(len(states)):
+    print(f"{ps(states[j]).ljust(8)}{x[j]:7.1f}")
+  print("D electoral votes=",d,", D win=",d_win,", tipping point=",ps(states[tip]).strip())
+  if not (wt is None):
+    print("weight=",f2(wt))
+  if not (y is None):
+    r_data = dat['races']
+    races = race_arrays(dat)[0]
+    for j in range(len(races)):
+      print(f"{races[j].ljust(12)}{y[0,j]:7.1f}")
+    for h in range(len(r_data['chambers'])):
+      print(f"{r_data['chambers'][h]}: D seats=",seats[0,h].item(),", D control=",int(control[0,h]))
+
+def run_until_precise(pars,dat,max_trials,joint,states):
+  """
+  Do batches of trials until the standard errors of the probability of a D win and of prob and RCL for each
+  of the given states are all less than pars['se'], or until we've done max_trials trials.
+  The first batch is only first_batch_size() trials, so that a loose target is met quickly. Since errors fall off like 1/sqrt(n),
+  the size of each later batch is a guess at how many more trials are needed, but never more than the number done so far.
+  With a given seed, the results for a total of n trials are exactly the same as for a single run of n trials, and don't
+  depend on the number of workers: the whole blocks used by run_trials() are kept from one batch to the next, and the partial
+  block at the end, whose random numbers depend on its size, is redone from scratch for each batch. This costs at most one
+  block of extra trials per batch.
+  """
+  target = pars['se']
+  block = trial_block_size(pars['sampling'])
+  whole = new_accumulators(dat['electoral_votes']) # totals for the whole blocks done so far
+  n_blocks = 0
+  n = min(first_batch_size(),max_trials)
+  while True:
+    if n//block>n_blocks:
+      for part in run_blocks(pars,dat,(n//block-n_blocks)*block,joint,n_blocks): # merged one at a time, in the same order as in run_trials()
+        merge_accumulators(whole,part)
+      n_blocks = n//block
+    acc = copy.deepcopy(whole)
+    if n>n_blocks*block:
+      merge_accumulators(acc,run_trials(pars,dat,n-n_blocks*block,joint,first_block=n_blocks))
+    worst = max_standard_error(standard_errors(acc),states)
+    if worst<target or n>=max_trials:
+      return acc
+    more = n*min((worst/target)**2-1.0,1.0)
+    n = min(n+max(1,math.ceil(more/first_batch_size()))*first_batch_size(),max_trials)
+
+def first_batch_size():
+  return 1000 # trials in the first batch done by run_until_precise(); later batches are multiples of this
+
+def standard_errors(acc):
+  """
+  Standard errors of the probability of a D win, the probability of D winning each state, and the RCL for each
+  state. Every one of these is a fraction of some number of trials, so its variance is p(1-p)/n. To keep
+  from being fooled into thinking we have a precise result when an event hasn't happened yet, p is estimated
+  as (x+1)/(n+2) rather than x/n. With importance sampling, the variances are estimated from the sums of squared
+  weights instead, and with variance reduction, from the differences among blocks of trials.
+  """
+  n = acc['n']
+  sq = acc['sq']
+  if not (acc['replicates'] is None):
+    return replicate_errors(acc['replicates'])
+  if sq is None:
+    errors = {'d_prob':binomial_error(acc['d_wins'],n),'prob':{},'rcl':{}}
+  else:
+    errors = {'d_prob':weighted_error(acc['d_wins'],sq['d_wins'],n),'prob':{},'rcl':{}}
+  for state in acc['state_d_wins']:
+    w = acc['state_d_wins'][state] # number of trials in which D won the state
+    if sq is None:
+      errors['prob'][state] = binomial_error(w,n)
+      errors['rcl'][state] = binomial_error(acc['rcl'][state],w)
+    else:
+      errors['prob'][state] = weighted_error(w,sq['state_d_wins'][state],n)
+      errors['rcl'][state] = weighted_ratio_error(acc['rcl'][state],sq['rcl'][state],w,sq['state_d_wins'][state])
+  return errors
+
+def replicate_errors(rep):
+  # Does the same thing as standard_errors(), using the totals for each block of trials from replicate_totals().
+  errors = {'d_prob':replicate_error(rep['d_wins'],rep['n']),'prob':{},'rcl':{}}
+  for state in rep['state_d_wins']:
+    errors['prob'][state] = replicate_error(rep['state_d_wins'][state],rep['n'])
+    errors['rcl'][state] = replicate_error(rep['rcl'][state],rep['state_d_wins'][state])
+  return errors
+
+def replicate_error(x,n):
+  """
+  Standard error of sum(x)/sum(n), where x[b] and n[b] are counts from independent blocks of trials, estimated from the scatter
+  of the blocks using the usual formula for a ratio, B/(B-1) sum((x[b]-p n[b])^2)/N^2, where p=sum(x)/sum(n), B is the number
+  of blocks, and N=sum(n). If the event happened in none of the trials or in all of them, the scatter is zero, so to avoid claiming a
+  precise result, we fall back on the error for independent trials, which is bigger.
+  """
+  (xx,nn,b) = (sum(x),sum(n),len(x))
+  if nn==0:
+    return None
+  if xx==0 or xx==nn:
+    return binomial_error(xx,nn)
+  if b<2:
+    return None
+  p = xx/nn
+  return math.sqrt(b/(b-1)*sum([(x[i]-p*n[i])**2 for i in range(b)]))/nn
+
+def weighted_error(x,x2,n):
+  # Standard error of x/n, where x is a sum of weights over n trials, and x2 is the sum of their squares.
+  if n==0:
+    return None
+  p = x/n
+  return math.sqrt(max(x2/n-p*p,0.0)/n)
+
+def weighted_ratio_error(x,x2,y,y2):
+  """
+  Standard error of the ratio r=x/y, where x and y are sums of weights, the events counted in x are a subset of those
+  counted in y, and x2 and y2 are the sums of the squares of the weights. This is the usual linearized estimate
+  sum(w^2 (X-rY)^2)/y^2.
+  """
+  if y==0:
+    return None
+  r = x/y
+  return math.sqrt(x2*(1.0-r)**2+(y2-x2)*r*r)/y
+
+def binomial_error(x,n):
+  if n==0:
+    return None
+  p = (x+1)/(n+2)
+  return math.sqrt(p*(1.0-p)/n)
+
+def max_standard_error(errors,states):
+  worst = errors['d_prob']
+  for state in states:
+    for key in ['prob','rcl']:
+      if errors[key][state] is None:
+        return math.inf
+      worst = max(worst,errors[key][state])
+  return worst
+
+def run_block(task):
+  # Do one block of trials, with a random number generator that depends only on the seed and the block number.
+  engine,dat,m,joint,seed,b = task
+  if engine=='python':
+    return run_trials_python(dat,m,joint,random.Random(f"{seed},{b}"))
+  if engine=='numpy':
+    return run_trials_numpy(dat,m,joint,np.random.default_rng([seed,b]))
+
+def engines():
+  return ['python','numpy','exact']
+
+def sampling_schemes():
+  return ['plain','antithetic','stratified','qmc'] # see sampled_uniforms()
+
+def trial_block_size(sampling='plain'):
+  """
+  Number of trials in each block, which is the unit of work handed to a worker process. With variance reduction, each block is
+  also one of the independent replicates from which the error bars are estimated, so the blocks are made smaller, to give enough of them.
+  """
+  if sampling=='plain':
+    return 20000
+  return 1024
+
+def run_trials_python(dat,n_trials,joint,rng):
+  """
+  The original engine, one trial at a time using the random module. Doesn't require numpy.
+  """
+  units = unit_lists(dat)
+  states = units[0]
+  n = len(states)
+  col = {}
+  for j in range(n):
+    col[states[j]] = j
   d_wins = 0
-  state_d_wins = {}
-  rcl = {} # republican win conditioned on losing this state
-  vote_avg = {}
-  for state in electoral_votes:
-    state_d_wins[state] = 0
-    rcl[state] = 0
-    vote_avg[state] = 0
+  state_d_wins = [0]*n
+  rcl = [0]*n
+  vote_sum = [0.0]*n
+  tipping = [0]*n
+  histogram = [0]*(electoral_college_size()+1)
+  margins = [] # the histograms of the margins are done all at once at the end, see margin_histogram_lists()
   joint_table = [[0,0],[0,0]]
-  electoral_college_histogram = [0] * n_predictit_bins()
-  tipping_histogram = {}
-  for state in electoral_votes:
-    tipping_histogram[state] = 0
   for i in range(n_trials):
-    t = do_one_trial({'safe_d':safe_d,'safe_r':safe_r,'aa':aa,'k':k,'s':s,'dist':dist,'tot':tot,'c':c,
-                 'ind':ind,'electoral_votes':electoral_votes,'lean':lean,'tie':tie})
-    d_wins += t['d_win']
-    electoral_college_histogram[t['bin']] += 1
-    tipping_histogram[t['tipping']] += 1
-    for state in states:
-      state_d_wins[state] += t['state_d_win'][state]
-      if t['state_d_win'][state]==1 and t['d_win']==0:
-        rcl[state] += 1
-    joint_events = [0,0] 
-    for i in range(2):
-      if joint[i]!='' and joint[i]!='nat':
-        joint_events[i] = t['state_d_win'][joint[i]]
+    x,d,d_win,tip = one_trial(dat,units,rng)
+    margins.append(x)
+    d_wins += d_win
+    histogram[d] += 1
+    tipping[tip] += 1
+    for j in range(n):
+      if x[j]>0.0:
+        state_d_wins[j] += 1
+        if d_win==0:
+          rcl[j] += 1
+      vote_sum[j] += x[j]
+    joint_events = [0,0]
+    for e in range(2):
+      if joint[e]!='' and joint[e]!='nat':
+        joint_events[e] = int(x[col[joint[e]]]>0.0)
       else:
-        joint_events[i] = t['d_win']
+        joint_events[e] = d_win
     joint_table[joint_events[0]][joint_events[1]] += 1
-    for state in states:
-      vote_avg[state] += t['vote'][state]/n_trials
-  prob = {}
-  for state in states:
-    prob[state] = state_d_wins[state]/n_trials
-    if prob[state]>0.0:
-      rcl[state] = rcl[state]/(n_trials*prob[state]) # number of times the joint event happened, divided by the number of times the
-                                                     # even conditioned on happened
+  acc = new_accumulators(dat['electoral_votes'])
+  acc['n'] = n_trials
+  acc['d_wins'] = d_wins
+  acc['joint_table'] = joint_table
+  acc['ev_histogram'] = histogram
+  for j in range(n):
+    (acc['state_d_wins'][states[j]],acc['rcl'][states[j]],acc['vote_sum'][states[j]],acc['tipping_histogram'][states[j]]) = (
+              state_d_wins[j],rcl[j],vote_sum[j],tipping[j])
+  margin_histogram = margin_histogram_lists(margins,n)
+  for j in range(n):
+    acc['margin_histogram'][states[j]] = margin_histogram[j]
+  return acc
+
+def margin_histogram_lists(margins,n):
+  # Does the same thing as margin_histogram_array(), for a list of lists of margins, without requiring numpy.
+  if not (np is None) and len(margins)>0:
+    return margin_histogram_array(np.array(margins))
+  (width,last) = (margin_bin_width(),n_margin_bins()-1)
+  result = [[0]*n_margin_bins() for j in range(n)]
+  for x in margins:
+    for j in range(n):
+      result[j][min(int((x[j]+100.0)/width),last)] += 1
+  return result
+
+def run_trials_numpy(dat,n_trials,joint,rng):
+  """
+  Does the same thing as run_trials_python(), but draws all the random numbers for a chunk of trials at once as
+  arrays, with one row per trial and one column per state, and does the bookkeeping as array operations.
+  The results are statistically the same as for the python engine, but not identical trial by trial, since
+  the random numbers come from a different generator.
+  If dat['tilt']>0, the random numbers are drawn using importance sampling (see tilted_bell_curve_array()), and
+  each trial counts with a weight rather than as 1. The totals are then sums of weights, and acc['sq'] has
+  the sums of the squares of the weights, which are needed for calculating error bars.
+  """
+  (safe_d,electoral_votes,tie,tilt) = (dat['safe_d'],dat['electoral_votes'],dat['tie'],dat['tilt'])
+  states,ev,ind_v,mu = state_arrays(dat)
+  n = len(states)
+  col = {}
+  for j in range(n):
+    col[states[j]] = j
+  acc = new_accumulators(electoral_votes)
+  acc['n'] = n_trials
+  if tilt>0.0:
+    acc['sq'] = new_squared_weights(electoral_votes)
+  if not (dat['races'] is None):
+    acc['races'] = new_race_accumulators(dat['races'])
+  margin_total = np.zeros((n,n_margin_bins()),dtype=np.int64) # becomes float if there are weights
+  for start in range(0,n_trials,numpy_chunk_size()):
+    m = min(numpy_chunk_size(),n_trials-start)
+    x,y,wt = draw_all_margins(dat,rng,m)
+    state_d_win,d,d_win = election_results(dat,x)
+    if not (y is None):
+      add_race_results(acc['races'],dat,y,d_win,wt)
+    r_state = state_d_win & ~d_win[:,None]
+    acc['d_wins'] += weighted_count(d_win,wt)
+    hist = np.bincount(d,weights=wt,minlength=electoral_college_size()+1)
+    margin_total = margin_total+margin_histogram_array(x,wt)
+    wins = weighted_count(state_d_win,wt)
+    r_wins = weighted_count(r_state,wt)
+    if wt is None:
+      vote_sum = x.sum(axis=0)
     else:
-      rcl[state] = None
+      vote_sum = wt@x
+    for j in range(n):
+      state = states[j]
+      acc['state_d_wins'][state] += wins[j]
+      acc['rcl'][state] += r_wins[j]
+      acc['vote_sum'][state] += float(vote_sum[j])
+    if not (wt is None):
+      wt2 = wt*wt
+      acc['sq']['d_wins'] += weighted_count(d_win,wt2)
+      wins2 = weighted_count(state_d_win,wt2)
+      r_wins2 = weighted_count(r_state,wt2)
+      for j in range(n):
+        acc['sq']['state_d_wins'][states[j]] += wins2[j]
+        acc['sq']['rcl'][states[j]] += r_wins2[j]
+    for e in range(electoral_college_size()+1):
+      acc['ev_histogram'][e] += hist[e].item()
+    tipping = np.bincount(tipping_points_array(safe_d,dat['safe_r'],x,ev,tie,d_win,2),weights=wt,minlength=n)
+    for j in range(n):
+      acc['tipping_histogram'][states[j]] += tipping[j].item()
+    joint_events = [None,None]
+    for j in range(2):
+      if joint[j]!='' and joint[j]!='nat':
+        joint_events[j] = state_d_win[:,col[joint[j]]]
+      else:
+        joint_events[j] = d_win
+    jt = np.bincount(2*joint_events[0].astype(np.int64)+joint_events[1],weights=wt,minlength=4)
+    for i in range(2):
+      for j in range(2):
+        acc['joint_table'][i][j] += jt[2*i+j].item()
+  for j in range(n):
+    acc['margin_histogram'][states[j]] = margin_total[j]
+  if dat['sampling']!='plain':
+    acc['replicates'] = replicate_totals(acc)
+  return acc
+
+def state_arrays(dat):
+  """
+  For the array-based code, the states are put in a fixed order, and their electoral votes, the sizes of their uncorrelated
+  fluctuations, and their expected margins are put in arrays in that order. Returns (states,ev,ind,mu).
+  """
+  states = list(dat['electoral_votes'].keys())
+  ev = np.array([dat['electoral_votes'][state] for state in states])
+  ind_v = np.array([dat['ind'][state] for state in states])
+  mu = np.array([dat['c']*(dat['lean'][state]+dat['k']) for state in states])
+  return (states,ev,ind_v,mu)
 
-  d_prob = d_wins/n_trials
-  output(pars,
-         {'d_prob':d_prob,'prob':prob,'rcl':rcl,'joint_table':joint_table,'aa':aa,'c':c},
-         {'electoral_votes':electoral_votes,'lean':lean,'predictit_prob':predictit_prob,'poll':poll,'undecided':undecided,
-            'safe_d':safe_d,'safe_r':safe_r,'tot':tot,'states':states,'ind':ind,'vote_avg':vote_avg,
-            'electoral_college_histogram':electoral_college_histogram,'tipping_histogram':tipping_histogram}
-        )
-  write_electoral_college_histogram('histogram.txt',electoral_college_histogram,n_trials)
-  write_tipping_histogram('tipping.txt',tipping_histogram,n_trials,states)
+def draw_margins(dat,rng,m):
+  """
+  Simulated margins for m trials, as an array with one row per trial and one column per state, in the order given by state_arrays().
+  Returns (x,wt), where wt is None, or, if doing importance sampling, an array of weights for the trials.
+  """
+  x,y,wt = draw_all_margins(dat,rng,m)
+  return (x,wt)
+
+def draw_all_margins(dat,rng,m):
+  """
+  Does the same thing as draw_margins(), and also simulates the senate or house races, if any, using the same national shock pop
+  for each trial, so that the races are correlated with the presidential race and with each other. Returns (x,y,wt), where y has
+  the margins in the races, one column per race, in the order given by race_arrays(), or is None if there are no races. The
+  races' random numbers are drawn after the states', so the margins in the states are the same as without any races.
+  With variance reduction, all the random numbers for the chunk come from sampled_uniforms(), in one array.
+  """
+  (aa,dist,tilt,sampling) = (dat['aa'],dat['dist'],dat['tilt'],dat['sampling'])
+  states,ev,ind_v,mu = state_arrays(dat)
+  n = len(states)
+  u = None
+  if sampling!='plain':
+    if tilt>0.0:
+      die(f"importance sampling (tilt>0) can't be used with sampling={sampling}")
+    n_races = 0
+    if not (dat['races'] is None):
+      n_races = len(dat['races']['seats'])
+    u = sampled_uniforms(sampling,rng,m,1+n+n_races) # columns are pop, then the states, then the races
+  if tilt>0.0:
+    z,wt = tilted_bell_curve_array(dist,rng,m,np.array([tilt]))
+    pop = aa*z[:,0]
+    if dat['tilt_states']==1:
+      if not (dat['cholesky'] is None):
+        die("tilt_states=1 can't be used with correlation")
+      zz,wt_states = tilted_bell_curve_array(dist,rng,m,-mu/ind_v,symmetric=False,p_shift=1.0/n)
+      wt = wt*wt_states
+    else:
+      zz = state_bell_curve_array(dat,rng,(m,n))
+  elif u is None:
+    pop = aa*bell_curve_array(dist,rng,m)
+    zz = state_bell_curve_array(dat,rng,(m,n))
+    wt = None
+  else:
+    pop = aa*bell_curve_inverse_cdf(dist,u[:,0])
+    zz = state_bell_curve_array(dat,rng,(m,n),u[:,1:n+1])
+    wt = None
+  x = bell_to_200_percent_range_array(pop[:,None]+ind_v*zz+mu)
+  y = None
+  if not (dat['races'] is None):
+    races,seats,chamber,ind_r,mu_r = race_arrays(dat)
+    if u is None:
+      zr = bell_curve_array(dist,rng,(m,len(races)))
+    else:
+      zr = bell_curve_inverse_cdf(dist,u[:,n+1:])
+    y = bell_to_200_percent_range_array(pop[:,None]+ind_r*zr+mu_r)
+  return (x,y,wt)
+
+def common_random_numbers(dat,rng,m,n):
+  """
+  The random numbers for m trials, for sensitivity(), scenarios(), and timeline_trials(), which compare several versions of the
+  inputs using the same trials. Returns (z0,zz), where z0 has the national shock in units of A, one per trial, and zz has the n states'
+  own fluctuations in units of their ind, one row per trial. Neither depends on A, the leans, or the polls, so for each version the margins
+  are aa*z0+ind*zz+mu with that version's values, and the differences between versions are due to the changes in the inputs
+  rather than to random noise.
+  """
+  return (bell_curve_array(dat['dist'],rng,m),state_bell_curve_array(dat,rng,(m,n)))
+
+def sampled_uniforms(sampling,rng,m,d):
+  """
+  Uniform random numbers for m trials, d of them per trial, spread out more evenly than independent ones would be, so that
+  averages over the trials come out more precisely. They're converted into bell-curve values using the inverse cdf. Column 0 is
+  used for the national shock pop. The schemes are:
+    antithetic - the second half of the trials use 1-u in place of the first half's u, so that every trial is paired with
+      its mirror image, with both pop and the states' own fluctuations reversed
+    stratified - the range from 0 to 1 for pop is divided into m equal parts, and each trial gets one of them
+    qmc - randomly scrambled Sobol sequence, a quasi-random sequence that fills the d-dimensional cube evenly (requires scipy)
+  Each call is a randomized replicate, independent of the others, which is what makes it possible to estimate error bars.
+  """
+  if sampling=='antithetic':
+    u = rng.random(((m+1)//2,d))
+    u = np.concatenate([u,1.0-u])[:m]
+  elif sampling=='stratified':
+    u = rng.random((m,d))
+    u[:,0] = (np.arange(m)+u[:,0])/m
+  elif sampling=='qmc':
+    try:
+      from scipy.stats import qmc # imported here, since importing scipy takes longer than a short run
+    except ImportError:
+      die("sampling=qmc requires the scipy library")
+    with warnings.catch_warnings():
+      warnings.simplefilter('ignore') # scipy complains if m isn't a power of 2, which happens for the last block
+      u = qmc.Sobol(d,scramble=True,seed=rng).random(m)
+  else:
+    die(f"illegal sampling={sampling}, should be one of {sampling_schemes()}")
+  return np.clip(u,1.0e-12,1.0-1.0e-12) # an inverse cdf can be infinite at 0 or 1
+
+def race_arrays(dat):
+  """
+  Like state_arrays(), for the races from race_data(). Returns (races,seats,chamber,ind,mu), where chamber is an array giving
+  the index of each race's chamber in the list dat['races']['chambers'].
+  """
+  r = dat['races']
+  races = list(r['seats'].keys())
+  seats = np.array([r['seats'][race] for race in races])
+  chamber = np.array([r['chambers'].index(r['chamber'][race]) for race in races])
+  ind_r = np.array([r['ind'][race] for race in races])
+  mu_r = np.array([r['c'][r['chamber'][race]]*(r['lean'][race]+dat['k']) for race in races])
+  return (races,seats,chamber,ind_r,mu_r)
+
+def race_results(dat,y,d_win):
+  """
+  Given the array of margins y in the races from draw_all_margins(), returns (race_d_win,d,control), where race_d_win is a boolean
+  array telling whether D won each race in each trial, and d and control have one column per chamber, giving D's number of seats
+  and whether D controls the chamber. In the senate, a tie is broken by the vice president, whose party is the one that won
+  the presidency.
+  """
+  r = dat['races']
+  races,seats,chamber,ind_r,mu_r = race_arrays(dat)
+  race_d_win = (y>0.0)
+  d = np.zeros((len(d_win),len(r['chambers'])),dtype=np.int64)
+  control = np.zeros((len(d_win),len(r['chambers'])),dtype=bool)
+  for h in range(len(r['chambers'])):
+    name = r['chambers'][h]
+    d[:,h] = r['safe_d'][name]+race_d_win[:,chamber==h].astype(np.int64)@seats[chamber==h]
+    control[:,h] = (d[:,h]*2>r['total'][name]) | ((d[:,h]*2==r['total'][name]) & d_win & (name=='senate'))
+  return (race_d_win,d,control)
+
+def race_outcome_index(d_win,control):
+  # For each trial, a number from 0 to 2^(number of chambers+1)-1, whose bits tell whether D won the presidency and each chamber, in that order.
+  index = d_win.astype(np.int64)
+  for h in range(control.shape[1]):
+    index = 2*index+control[:,h]
+  return index
+
+def add_race_results(acc,dat,y,d_win,wt):
+  # Add the results of the races in a chunk of trials to the totals from new_race_accumulators().
+  r = dat['races']
+  races = race_arrays(dat)[0]
+  race_d_win,d,control = race_results(dat,y,d_win)
+  wins = weighted_count(race_d_win,wt)
+  for j in range(len(races)):
+    acc['race_d_wins'][races[j]] += wins[j]
+  controls = weighted_count(control,wt)
+  if wt is None:
+    seat_sum = d.sum(axis=0).tolist()
+  else:
+    seat_sum = (wt@d).tolist()
+  for h in range(len(r['chambers'])):
+    acc['control'][r['chambers'][h]] += controls[h]
+    acc['seat_sum'][r['chambers'][h]] += seat_sum[h]
+  outcomes = np.bincount(race_outcome_index(d_win,control),weights=wt,minlength=len(acc['outcomes']))
+  for i in range(len(acc['outcomes'])):
+    acc['outcomes'][i] += outcomes[i].item()
+
+def state_bell_curve_array(dat,rng,shape,u=None):
+  """
+  The states' own random fluctuations, in units of ind. Normally these are independent. If there is a correlation matrix, then
+  correlated normal random numbers are generated by multiplying by its Cholesky factor, all the trials in one matrix product.
+  For dist=cauchy, each one is then converted to a Cauchy random number with the same cumulative probability, so that each
+  state's fluctuations still have the usual distribution, and the correlations among states are like the normal ones.
+  If u is given, it's an array of uniform random numbers from sampled_uniforms(), which are used instead of drawing new ones.
+  """
+  (dist,cholesky) = (dat['dist'],dat['cholesky'])
+  if cholesky is None:
+    if u is None:
+      return bell_curve_array(dist,rng,shape)
+    return bell_curve_inverse_cdf(dist,u)
+  if u is None:
+    z = bell_curve_array('normal',rng,shape)@cholesky.T
+  else:
+    z = bell_curve_inverse_cdf('normal',u)@cholesky.T
+  if dist=='normal':
+    return z
+  if dist=='cauchy':
+    # Work with the upper tail, 1-cdf, so that there's no loss of precision for big values of z.
+    scale = iqr('normal')/iqr('cauchy')
+    return np.sign(z)*scale/np.tan(np.pi*normal_upper_tail_array(np.abs(z)))
+  die("illegal value of dist in state_bell_curve_array")
+
+def normal_upper_tail_array(x):
+  """
+  Probability that a standard normal random variable is greater than x, for an array of values of x>=0. This is 1/2 of
+  the complementary error function, calculated using the Chebyshev approximation from Numerical Recipes, which has a fractional
+  error less than 1.2x10^-7 everywhere.
+  """
+  z = x/math.sqrt(2.0)
+  t = 1.0/(1.0+0.5*z)
+  poly = -1.26551223+t*(1.00002368+t*(0.37409196+t*(0.09678418+t*(-0.18628806+t*(0.27886807+t*(-1.13520398+t*(1.48851587
+              +t*(-0.82215223+t*0.17087277))))))))
+  return 0.5*t*np.exp(-z*z+poly)
 
+def election_results(dat,x):
+  """
+  Given the array of margins x from draw_margins(), returns (state_d_win,d,d_win), where state_d_win is a boolean array
+  telling whether D won each state in each trial, d is D's electoral votes in each trial, and d_win tells whether D won.
+  """
+  states,ev,ind_v,mu = state_arrays(dat)
+  state_d_win = (x>0.0)
+  d = dat['safe_d']+state_d_win.astype(np.int64)@ev
+  d_win = (d*2>dat['tot']) | ((d*2==dat['tot']) & (dat['tie']==1))
+  return (state_d_win,d,d_win)
+
+def simulate_outcomes(dat,n_trials,seed=None):
+  """
+  Simulate n_trials elections and keep the outcome of every trial, rather than just the totals that main() uses, so that
+  any question about them can be answered later using probability(). Returns a dict with keys states, state_d_win (boolean
+  array, one row per trial), d_win, d (D's electoral votes), and wt (None unless doing importance sampling). If there are
+  senate or house races, race_d_win and control say who won each race and each chamber, whose names are in races and chambers.
+  """
+  if np is None:
+    die("simulate_outcomes requires the numpy library")
+  rng = np.random.default_rng(seed)
+  parts = []
+  for start in range(0,n_trials,numpy_chunk_size()):
+    m = min(numpy_chunk_size(),n_trials-start)
+    x,y,wt = draw_all_margins(dat,rng,m)
+    state_d_win,d,d_win = election_results(dat,x)
+    race_d_win,control = (None,None)
+    if not (y is None):
+      race_d_win,seats,control = race_results(dat,y,d_win)
+    parts.append((state_d_win,d,d_win,wt,race_d_win,control))
+  result = {'states':state_arrays(dat)[0],'n_trials':n_trials,'races':[],'chambers':[]}
+  if not (dat['races'] is None):
+    result['races'] = race_arrays(dat)[0]
+    result['chambers'] = dat['races']['chambers']
+  for i,key in enumerate(['state_d_win','d','d_win','wt','race_d_win','control']):
+    if parts[0][i] is None:
+      result[key] = None
+    else:
+      result[key] = np.concatenate([part[i] for part in parts])
+  return result
+
+def probability(trials,event,given=None):
+  """
+  Probability of an event, optionally conditioned on another event, using the trials returned by simulate_outcomes(). Events are
+  written like 'pa', meaning that D wins PA, or 'nat', meaning that D wins the election, combined using ! (not),
+  & (and), | (or), and parentheses, e.g., '!nat & (pa | wi)'. If there are senate or house races, the name of a race or a
+  chamber means that D wins it, e.g., 'nat & senate & house'. Returns (p,se,n), where se is the standard error
+  and n is the number of trials in which the condition was true. The trials can also be a trial store from open_trial_store().
+  """
+  if 'bits' in trials:
+    return stored_probability(trials,event,given)
+  col = {}
+  for j in range(len(trials['states'])):
+    col[trials['states'][j]] = ('state_d_win',j)
+  for j in range(len(trials['races'])):
+    col[trials['races'][j]] = ('race_d_win',j)
+  for j in range(len(trials['chambers'])):
+    col[trials['chambers'][j]] = ('control',j)
+  def lookup(name):
+    if name=='nat':
+      return trials['d_win']
+    if not (name in col):
+      die(f"unknown state {name} in event")
+    key,j = col[name]
+    return trials[key][:,j]
+  happened = evaluate_event(parse_event(event),lookup)
+  if given is None or given=='':
+    condition = np.ones(len(happened),dtype=bool)
+  else:
+    condition = evaluate_event(parse_event(given),lookup)
+  wt = trials['wt']
+  if wt is None:
+    n = int(np.count_nonzero(condition))
+    x = int(np.count_nonzero(happened & condition))
+    if n==0:
+      return (None,None,0)
+    return (x/n,binomial_error(x,n),n)
+  y = float(wt@condition)
+  x = float(wt@(happened & condition))
+  if y==0.0:
+    return (None,None,0)
+  return (x/y,weighted_ratio_error(x,float((wt*wt)@(happened & condition)),y,float((wt*wt)@condition)),int(np.count_nonzero(condition)))
+
+def parse_event(event):
+  """
+  Parse an event like '!nat & (pa | wi)' into a tree of nested tuples, e.g., ('and',('not','nat'),('or','pa','wi')). Names are
+  state abbreviations as in data.csv, or nat for the national result. The operators, in order of increasing precedence, are | & !.
+  """
+  tokens = re.findall(r"[a-z0-9_\-]+|[!&|()]|\S",event.lower())
+  pos = [0]
+  def peek():
+    return tokens[pos[0]] if pos[0]<len(tokens) else None
+  def take():
+    pos[0] += 1
+    return tokens[pos[0]-1]
+  def expr():
+    tree = term()
+    while peek()=='|':
+      take()
+      tree = ('or',tree,term())
+    return tree
+  def term():
+    tree = factor()
+    while peek()=='&':
+      take()
+      tree = ('and',tree,factor())
+    return tree
+  def factor():
+    t = peek()
+    if t is None:
+      die(f"unexpected end of event {event}")
+    take()
+    if t=='!':
+      return ('not',factor())
+    if t=='(':
+      tree = expr()
+      if peek()!=')':
+        die(f"missing ) in event {event}")
+      take()
+      return tree
+    if re.search(r"^[a-z0-9_\-]+$",t):
+      return t
+    die(f"syntax error in event {event} at {t}")
+  tree = expr()
+  if not (peek() is None):
+    die(f"syntax error in event {event} at {peek()}")
+  return tree
+
+def evaluate_event(tree,lookup):
+  """
+  Evaluate a tree from parse_event(). The function lookup returns an array for a state or nat, and the operators are carried out
+  using python's ~ & | operators, so this works both for boolean arrays and for arrays of bits packed into integers.
+  """
+  if isinstance(tree,str):
+    return lookup(tree)
+  if tree[0]=='not':
+    return ~evaluate_event(tree[1],lookup)
+  if tree[0]=='and':
+    return evaluate_event(tree[1],lookup) & evaluate_event(tree[2],lookup)
+  return evaluate_event(tree[1],lookup) | evaluate_event(tree[2],lookup)
+
+def trial_store_command(pars,dat):
+  # election.py store=... writes a trial store, or, with query=..., answers a question using one that was written earlier.
+  if pars['query']=='':
+    seed = pars['seed']
+    if seed==0:
+      seed = None
+    write_trial_store(pars['store'],dat,pars['n_trials'],seed,pars['store_margins']==1)
+    print(f"Saved {pars['n_trials']} trials in {pars['store']}")
+    return
+  store = open_trial_store(pars['store'])
+  p,se,n = probability(store,pars['query'],pars['given'])
+  if p is None:
+    die(f"the condition {pars['given']} never happened in the stored trials")
+  condition = ''
+  if pars['given']!='':
+    condition = f" given {pars['given']}"
+  print(f"P({pars['query']}{condition}) = {p:.5f} +- {se:.5f}, from {n} of {store['n_trials']} trials")
+
+def write_trial_store(filename,dat,n_trials,seed=None,margins=False):
+  """
+  Simulate n_trials elections and save the outcome of every one of them, so that any question about them can be answered
+  later, without rerunning the simulation, using open_trial_store() and probability(). The file has one row for each
+  state, plus one for nat, with one bit per trial, packed 8 trials to a byte, so that 10^7 trials take about 1.2 Mb per state.
+  A description of the contents goes in filename.json. If margins is true, D's margin in every state in every trial is also
+  saved, in filename.margins, as an integer number of hundredths of a percent.
+  """
+  if np is None:
+    die("a trial store requires the numpy library")
+  if dat['tilt']>0.0:
+    die("a trial store can't be used with importance sampling, tilt>0")
+  states = state_arrays(dat)[0]
+  n = len(states)
+  bits = np.memmap(filename,dtype=np.uint8,mode='w+',shape=(n+1,(n_trials+7)//8))
+  if margins:
+    margin_store = np.memmap(filename+'.margins',dtype=np.int16,mode='w+',shape=(n,n_trials))
+  rng = np.random.default_rng(seed)
+  for start in range(0,n_trials,numpy_chunk_size()): # numpy_chunk_size() is a multiple of 8, so each chunk starts on a byte
+    m = min(numpy_chunk_size(),n_trials-start)
+    x = draw_margins(dat,rng,m)[0] # no weights, since there's no importance sampling
+    results = election_results(dat,x)
+    (state_d_win,d_win) = (results[0],results[2])
+    b = start//8
+    bits[:n,b:b+(m+7)//8] = np.packbits(state_d_win.T,axis=1)
+    bits[n,b:b+(m+7)//8] = np.packbits(d_win)
+    if margins:
+      margin_store[:,start:start+m] = np.rint(100.0*x.T).astype(np.int16)
+  bits.flush()
+  if margins:
+    margin_store.flush()
+  with open(filename+'.json','w') as f:
+    json.dump({'states':states,'n_trials':n_trials,'margins':margins,'engine_version':engine_version()},f)
+
+def open_trial_store(filename):
+  """
+  Open a trial store written by write_trial_store(). The files are memory-mapped rather than read in, so this is fast even when
+  they're big. Returns a dict with keys states, n_trials, bits (one row per state, plus a final row for nat), and margins
+  (one row per state, in hundredths of a percent, or None if they weren't saved).
+  """
+  if np is None:
+    die("a trial store requires the numpy library")
+  try:
+    with open(filename+'.json','r') as f:
+      info = json.load(f)
+  except OSError:
+    die(f"can't read the description of the trial store, {filename}.json")
+  if info['engine_version']!=engine_version():
+    die(f"the trial store {filename} was written by a different version of this program")
+  (states,n_trials) = (info['states'],info['n_trials'])
+  store = {'states':states,'n_trials':n_trials,'margins':None}
+  store['bits'] = np.memmap(filename,dtype=np.uint8,mode='r',shape=(len(states)+1,(n_trials+7)//8))
+  if info['margins']:
+    store['margins'] = np.memmap(filename+'.margins',dtype=np.int16,mode='r',shape=(len(states),n_trials))
+  return store
+
+def stored_probability(store,event,given=None):
+  """
+  Does the same thing as probability(), for a trial store. The events are evaluated using bitwise operations on the packed
+  bits, 8 trials at a time, and the trials in which they happened are counted by counting the bits that are set.
+  """
+  row = {}
+  for j in range(len(store['states'])):
+    row[store['states'][j]] = j
+  row['nat'] = len(store['states'])
+  def lookup(name):
+    if not (name in row):
+      die(f"unknown state {name} in event")
+    return store['bits'][row[name]]
+  n_trials = store['n_trials']
+  happened = evaluate_event(parse_event(event),lookup)
+  if given is None or given=='':
+    n = n_trials
+    x = count_bits(happened,n_trials)
+  else:
+    condition = evaluate_event(parse_event(given),lookup)
+    n = count_bits(condition,n_trials)
+    x = count_bits(happened & condition,n_trials)
+  if n==0:
+    return (None,None,0)
+  return (x/n,binomial_error(x,n),n)
+
+def count_bits(bits,n_trials):
+  """
+  Count the bits that are set in a row of packed bits. The last byte may have bits past the end of the trials, which are zero in
+  the file but become ones when an event has a ! in it, so these are masked off.
+  """
+  last = bits[-1] & ((0xff<<(8*len(bits)-n_trials)) & 0xff)
+  if hasattr(np,'bitwise_count'): # numpy 2.0 or later
+    total = int(np.bitwise_count(bits[:-1]).sum(dtype=np.int64))
+  else:
+    total = int(popcount_table()[bits[:-1]].sum(dtype=np.int64))
+  return total+popcount_table()[last].item()
+
+def popcount_table():
+  # number of bits that are set in each possible byte
+  return np.array([bin(i).count('1') for i in range(256)],dtype=np.uint8)
+
+def weighted_count(events,wt):
+  """
+  Count the trials in which a boolean event happened, or, if wt isn't None, add up their weights. If events is
+  two-dimensional, with one column per state, this is done for each column, and the result is a list.
+  """
+  if wt is None:
+    result = np.count_nonzero(events,axis=0)
+  else:
+    result = wt@events
+  if events.ndim==1:
+    return result.item()
+  return result.tolist()
+
+def tilted_bell_curve_array(dist,rng,m,shift,symmetric=True,p_shift=0.5):
+  """
+  Importance sampling for rare events. Returns an array z of m rows, one column per element of shift, and an array of
+  m weights. Each column is drawn from a mixture of the usual bell curve with copies of it shifted by +shift and -shift (or
+  only +shift, if symmetric is False), so that extreme values are sampled much more often. The shifted copies get a total
+  probability p_shift. The weight for each row is the ratio of the bell curve's probability density to the mixture's,
+  multiplied over the columns. Keeping some probability for the unshifted bell curve means that no weight can be bigger than
+  1/(1-p_shift) per column, so the method can't be thrown off very badly even when the shift is a bad choice.
+  """
+  n = len(shift)
+  z = bell_curve_array(dist,rng,(m,n))
+  which = rng.random((m,n))
+  if symmetric:
+    sgn = np.where(which<0.5*p_shift,-1.0,np.where(which<p_shift,1.0,0.0))
+  else:
+    sgn = np.where(which<p_shift,1.0,0.0)
+  z = z+sgn*shift
+  f = bell_curve_density(dist,z)
+  if symmetric:
+    g = (1.0-p_shift)*f+0.5*p_shift*(bell_curve_density(dist,z-shift)+bell_curve_density(dist,z+shift))
+  else:
+    g = (1.0-p_shift)*f+p_shift*bell_curve_density(dist,z-shift)
+  return (z,np.prod(f/g,axis=1))
+
+def bell_curve_density(dist,x):
+  # Probability density of the bell curves generated by bell_curve(), applied to an array.
+  if dist=='normal':
+    return np.exp(-0.5*x*x)/math.sqrt(2.0*math.pi)
+  if dist=='cauchy':
+    scale = iqr('normal')/iqr('cauchy')
+    return 1.0/(math.pi*scale*(1.0+(x/scale)**2))
+  die("illegal value of dist in bell_curve_density")
+
+def exact_probabilities(dat,joint):
+  """
+  Calculate the same things as the Monte Carlo engines, but without any random sampling. Once the nationally
+  correlated shock pop is fixed, the states are independent, and each one has a probability of going D that we can
+  write down in closed form. We integrate over pop numerically, and for each value of pop, we build up the
+  probability distribution of D's electoral votes one state at a time, like multiplying polynomials.
+  Returns totals in the same format as run_trials(), but with n=1, so that everything is already a probability.
+  Tipping points aren't calculated, and tipping_histogram is None.
+  """
+  (dist,electoral_votes) = (dat['dist'],dat['electoral_votes'])
+  states = list(electoral_votes.keys())
+  n = len(states)
+  u,w,pop,p,d_win,r_state,full = exact_given_pop(dat)
+  ind_v = np.array([dat['ind'][state] for state in states])
+  mu = np.array([dat['c']*(dat['lean'][state]+dat['k']) for state in states])
+  acc = new_accumulators(electoral_votes)
+  acc['n'] = 1.0
+  acc['d_wins'] = float(w@d_win)
+  vote_sum = exact_vote_avg(dist,pop,w,u,ind_v,mu)
+  for i in range(n):
+    state = states[i]
+    acc['state_d_wins'][state] = float(w@p[:,i])
+    acc['rcl'][state] = float(w@r_state[:,i])
+    acc['vote_sum'][state] = float(vote_sum[i])
+  acc['ev_histogram'] = (w@full).tolist()
+  margin_histogram = exact_margin_histograms(dist,pop,w,ind_v,mu)
+  for i in range(n):
+    acc['margin_histogram'][states[i]] = margin_histogram[i]
+  # Probabilities of the events used in the joint table, for each value of pop. For a single state, or for a state and the
+  # national result, these are all things we have on hand already.
+  col = {}
+  for i in range(n):
+    col[states[i]] = i
+  event = []
+  for j in range(2):
+    if joint[j]!='' and joint[j]!='nat':
+      event.append(col[joint[j]])
+    else:
+      event.append('nat')
+  for x in range(2):
+    for y in range(2):
+      acc['joint_table'][x][y] = float(w@exact_joint_probability(event,(x,y),p,d_win,r_state))
+  acc['tipping_histogram'] = None
+  return acc
+
+def exact_given_pop(dat):
+  """
+  The part of exact_probabilities() that is done separately for each value of the national shock pop. Returns
+  (u,w,pop,p,d_win,r_state,full), where u and w are the quadrature nodes and weights, and, for each node, p[q,i] is the probability
+  that D wins state i, d_win is the probability that D wins the election, r_state[q,i] is the probability that D wins state
+  i but loses the election, and full[q,e] is the probability that D gets e electoral votes.
+  """
+  if np is None:
+    die("engine=exact requires the numpy library")
+  if not (dat['cholesky'] is None):
+    die("engine=exact can't be used with correlation, since the states are then not independent once the national shift is fixed")
+  if not (dat['races'] is None):
+    die("races requires engine=numpy")
+  (safe_d,aa,k,dist,tot,c,ind,electoral_votes,lean,tie) = (dat['safe_d'],dat['aa'],dat['k'],dat['dist'],
+              dat['tot'],dat['c'],dat['ind'],dat['electoral_votes'],dat['lean'],dat['tie'])
+  states = list(electoral_votes.keys())
+  n = len(states)
+  ev = [electoral_votes[state] for state in states]
+  ind_v = np.array([ind[state] for state in states])
+  mu = np.array([c*(lean[state]+k) for state in states])
+  u,w = quadrature_nodes()
+  pop = aa*bell_curve_inverse_cdf(dist,u)
+  p = bell_curve_cdf(dist,(pop[:,None]+mu)/ind_v) # p[q,i] = prob that state i goes D, given the qth value of pop
+  need = votes_needed(tot,tie)
+  # prefix[i] = distribution of D's electoral votes from the safe states plus states 0...i-1
+  # suffix[i] = distribution of D's electoral votes from states i...n-1
+  prefix = [electoral_vote_distribution(safe_d,len(u))]
+  for i in range(n):
+    prefix.append(add_state_to_distribution(prefix[i],ev[i],p[:,i]))
+  suffix = [None]*(n+1)
+  suffix[n] = electoral_vote_distribution(0,len(u))
+  for i in reversed(range(n)):
+    suffix[i] = add_state_to_distribution(suffix[i+1],ev[i],p[:,i])
+  full = prefix[n]
+  d_win = full[:,need:].sum(axis=1)
+  # For each state, the probability that D wins the state but R wins the election: D's other electoral votes must total
+  # less than need-ev[i].
+  r_given_state = np.zeros((len(u),n))
+  for i in range(n):
+    cum = np.cumsum(suffix[i+1],axis=1) # cum[q,x] = prob that states after i give D <=x votes
+    x = need-ev[i]-1-np.arange(tot+1) # for each count e from the earlier states, the most that the later ones can give
+    later = np.where(x>=0,cum[:,np.clip(x,0,tot)],0.0)
+    r_given_state[:,i] = (prefix[i]*later).sum(axis=1)
+  r_state = p*r_given_state
+  return (u,w,pop,p,d_win,r_state,full)
+
+def votes_needed(tot,tie):
+  # D wins if he gets at least this many electoral votes.
+  if tie==1 and tot%2==0:
+    return tot//2
+  return tot//2+1
+
+def exact_win_probabilities(dat,n_nodes=None):
+  """
+  The probability of a D win, and an array of the probabilities of D winning each state, in the order given by state_arrays(), calculated
+  in the same way as in exact_given_pop(), but without anything else, which makes it several times faster. The number of quadrature nodes
+  can be given.
+  """
+  if np is None:
+    die("engine=exact requires the numpy library")
+  if not (dat['cholesky'] is None):
+    die("engine=exact can't be used with correlation, since the states are then not independent once the national shift is fixed")
+  states,ev,ind_v,mu = state_arrays(dat)
+  u,w = quadrature_nodes(n_nodes)
+  pop = dat['aa']*bell_curve_inverse_cdf(dat['dist'],u)
+  p = bell_curve_cdf(dat['dist'],(pop[:,None]+mu)/ind_v)
+  x = electoral_vote_distribution(dat['safe_d'],len(u))
+  for i in range(len(states)):
+    x = add_state_to_distribution(x,ev[i],p[:,i])
+  return (float(w@x[:,votes_needed(dat['tot'],dat['tie']):].sum(axis=1)),w@p)
+
+def exact_joint_probability(event,outcome,p,d_win,r_state):
+  """
+  Helper for exact_probabilities(). Returns, for each value of pop, the probability that event[0] has outcome[0]
+  and event[1] has outcome[1], where each event is either a column of p or 'nat'.
+  """
+  e1,e2 = event
+  o1,o2 = outcome
+  if e1==e2:
+    if o1!=o2:
+      return np.zeros(len(d_win))
+    if e1=='nat':
+      q = d_win
+    else:
+      q = p[:,e1]
+    return q if o1==1 else 1.0-q
+  if e1!='nat' and e2!='nat':
+    q1 = p[:,e1] if o1==1 else 1.0-p[:,e1] # states are independent once pop is fixed
+    q2 = p[:,e2] if o2==1 else 1.0-p[:,e2]
+    return q1*q2
+  if e1=='nat':
+    return exact_joint_probability((e2,e1),(o2,o1),p,d_win,r_state)
+  # e1 is a state, e2 is the national result
+  d_state_r_nat = r_state[:,e1]
+  d_state_d_nat = p[:,e1]-d_state_r_nat
+  if o1==1:
+    return d_state_d_nat if o2==1 else d_state_r_nat
+  # R wins the state
+  return d_win-d_state_d_nat if o2==1 else 1.0-p[:,e1]-(d_win-d_state_d_nat)
+
+def electoral_vote_distribution(votes,n_nodes):
+  # Array of probabilities for 0 to 538 electoral votes, for each quadrature node, with all the probability at votes.
+  x = np.zeros((n_nodes,electoral_college_size()+1))
+  x[:,votes] = 1.0
+  return x
+
+def add_state_to_distribution(x,v,p):
+  # Add in a state with v electoral votes, which goes D with probability p (one value per quadrature node).
+  y = x*(1.0-p)[:,None]
+  y[:,v:] += x[:,:x.shape[1]-v]*p[:,None]
+  return y
+
+def exact_vote_avg(dist,pop,w,u,ind_v,mu):
+  # Mean of each state's simulated margin, integrating over both pop and the state's own fluctuation.
+  z = bell_curve_inverse_cdf(dist,u)
+  x = bell_to_200_percent_range_array(pop[:,None,None]+ind_v*z[None,:,None]+mu) # indices are (pop node, state node, state)
+  return np.einsum('q,r,qri->i',w,w,x)
+
+def exact_margin_histograms(dist,pop,w,ind_v,mu):
+  """
+  The probability of each state's margin falling in each of the bins used for margin_histogram in new_accumulators(),
+  integrating over pop.
+  For each value of pop, the probability that the margin is below the edge of a bin is the cdf of the state's own fluctuation,
+  evaluated at the edge, after undoing bell_to_200_percent_range(). Returns an array with one row per state.
+  """
+  n = 100.0/(math.pi/2)
+  edges = n*np.tan((-100.0+margin_bin_width()*np.arange(n_margin_bins()+1))/n) # +-100% map to +-infinity, give or take rounding
+  result = np.zeros((len(mu),n_margin_bins()))
+  for i in range(len(mu)):
+    cdf = w@bell_curve_cdf_array(dist,(edges[None,:]-pop[:,None]-mu[i])/ind_v[i])
+    cdf[0],cdf[-1] = (0.0,1.0)
+    result[i] = np.diff(cdf)
+  return result
+
+def bell_curve_cdf_array(dist,x):
+  """
+  Does the same thing as bell_curve_cdf(), but faster for a big array, since for dist=normal it uses normal_upper_tail_array(),
+  which has a fractional error less than 1.2x10^-7, rather than python's erf(), one number at a time.
+  """
+  if dist=='normal':
+    tail = normal_upper_tail_array(np.abs(x))
+    return np.where(x>=0.0,1.0-tail,tail)
+  return bell_curve_cdf(dist,x)
+
+def quadrature_nodes(n=None):
+  """
+  Gauss-Legendre nodes u and weights w for integrating over the interval (0,1). A random variable drawn from
+  the bell curve can be written as the inverse cdf of a uniform variable u, so integrals over pop are done
+  as integrals over u. The number of nodes defaults to n_quadrature_nodes().
+  """
+  if n is None:
+    n = n_quadrature_nodes()
+  x,w = np.polynomial.legendre.leggauss(n)
+  return ((x+1.0)/2.0,w/2.0)
+
+def n_quadrature_nodes():
+  return 256
+
+def bell_curve_cdf(dist,x):
+  # Cumulative distribution function of the bell curves generated by bell_curve(), applied to an array.
+  if dist=='normal':
+    return 0.5*(1.0+np.vectorize(math.erf)(x/math.sqrt(2.0)))
+  if dist=='cauchy':
+    scale = iqr('normal')/iqr('cauchy')
+    return 0.5+np.arctan(x/scale)/np.pi
+  die("illegal value of dist in bell_curve_cdf")
+
+def bell_curve_inverse_cdf(dist,u):
+  # Inverse of bell_curve_cdf(), applied to an array.
+  if dist=='normal':
+    return inverse_normal_cdf_array(u)
+  if dist=='cauchy':
+    scale = iqr('normal')/iqr('cauchy')
+    return scale*np.tan(np.pi*(u-0.5))
+  die("illegal value of dist in bell_curve_inverse_cdf")
+
+def numpy_chunk_size():
+  return 100000 # number of trials done at once by engine=numpy; limits memory use
+
+def n_margin_bins():
+  return 1000 # number of bins in the histograms of each state's margin, from -100% to 100%
+
+def margin_bin_width():
+  return 200.0/n_margin_bins()
+
+def predictit_histogram(ev_histogram):
+  # Add up the histogram of D's electoral votes into predictit's bins, see vote_margin_to_predictit_bin().
+  result = [0]*n_predictit_bins()
+  for d in range(electoral_college_size()+1):
+    result[vote_margin_to_predictit_bin(2*d-electoral_college_size())[0]] += ev_histogram[d]
+  return result
+
+def histogram_quantile(histogram,q,lo=0.0,width=1.0,interpolate=False):
+  """
+  The value below which a fraction q of the total of a histogram lies, where bin b covers lo+b*width to lo+(b+1)*width.
+  If interpolate is true, the value is interpolated within the bin, otherwise it's the bottom of the bin, which for
+  the histogram of electoral votes is just the number of electoral votes.
+  """
+  total = sum(histogram)
+  target = q*total
+  cum = 0.0
+  for b in range(len(histogram)):
+    if histogram[b]>0 and cum+histogram[b]>=target:
+      if interpolate:
+        return lo+width*(b+(target-cum)/histogram[b])
+      return lo+width*b
+    cum += histogram[b]
+  return lo+width*len(histogram)
+
+def percentiles():
+  return [5,25,50,75,95] # shown for each state's margin
+
+def output_distributions(acc,states):
+  # Print the mean, median, and 90% interval for D's electoral votes, derived from the histogram.
+  ev = acc['ev_histogram']
+  total = sum(ev)
+  mean = sum([e*ev[e] for e in range(len(ev))])/total
+  print("D electoral votes: mean=",f1(mean),", median=",int(histogram_quantile(ev,0.5)),", 90% interval=",
+        int(histogram_quantile(ev,0.05)),"to",int(histogram_quantile(ev,0.95)))
+
+def write_electoral_vote_distribution(filename,ev_histogram,n_trials):
+  with open(filename,'w') as f:
+    print("electoral votes,prob",file=f)
+    for e in range(len(ev_histogram)):
+      print(f"{e},{ev_histogram[e]/n_trials}",file=f)
+
+def write_margin_percentiles(filename,acc,states):
+  # Percentiles of D's margin in each state, estimated from the histograms, by interpolating within each bin.
+  with open(filename,'w') as f:
+    print(",".join(['state','mean']+[f"p{q}" for q in percentiles()]),file=f)
+    histograms = accumulators_to_json(acc)['margin_histogram']
+    for state in states:
+      h = histograms[state]
+      row = [state,str(acc['vote_sum'][state]/acc['n'])]
+      for q in percentiles():
+        row.append(f"{histogram_quantile(h,q/100.0,-100.0,margin_bin_width(),True):.2f}")
+      print(",".join(row),file=f)
 
 def write_tipping_histogram(filename,histogram,n_trials,states):
   with open(filename,'w') as f:
@@ -114,16 +2592,19 @@ def write_tipping_histogram(filename,histogram,n_trials,states):
     for state in states:
       print(f"  {state}  {f3(histogram[state]/n_trials)}",file=f)
 
-def write_electoral_college_histogram(filename,electoral_college_histogram,n_trials):
+def write_electoral_college_histogram(filename,electoral_college_histogram,n_trials,small=False):
+  # If small is true, print the probabilities in a format that shows small values, which we can estimate using importance sampling.
   with open(filename,'w') as f:
     print("probabilities of electoral college margins:",file=f)
     for b in range(n_predictit_bins()):
       r = predictit_bin_to_margin_range(b)
-      print("  ",r[0],"to",r[1],", ",f2(electoral_college_histogram[b]/n_trials),file=f)
+      p = electoral_college_histogram[b]/n_trials
+      print("  ",r[0],"to",r[1],", ",("%9.2e" % p) if small else f2(p),file=f)
 
 def output(pars,results,sd):
-  (a,k,s,dist,n_trials,joint,swing) = (pars['a'],pars['k'],pars['s'],pars['dist'],pars['n_trials'],pars['joint'],pars['swing'])
-  (d_prob,prob,rcl,joint_table,aa,c) = (results['d_prob'],results['prob'],results['rcl'],results['joint_table'],results['aa'],results['c'])
+  (a,k,s,dist,joint,swing) = (pars['a'],pars['k'],pars['s'],pars['dist'],pars['joint'],pars['swing'])
+  (d_prob,prob,rcl,joint_table,aa,c,n,errors) = (results['d_prob'],results['prob'],results['rcl'],results['joint_table'],
+            results['aa'],results['c'],results['n'],results['errors'])
   (electoral_votes,lean,predictit_prob,poll,undecided,safe_d,safe_r,tot,states,ind,vote_avg) = (
             sd['electoral_votes'],sd['lean'],sd['predictit_prob'],sd['poll'],sd['undecided'],
             sd['safe_d'],sd['safe_r'],sd['tot'],sd['states'],sd['ind'],sd['vote_avg'])
@@ -140,20 +2621,29 @@ def output(pars,results,sd):
   #print("mean(simulation)-mean(predictit)=",f2(prob_mean-predictit_mean),"; if predictit data are current, this can be used to adjust the parameter k")
   #...to be useful, this feature should restrict itself to real swing states
 
-  print("prob of D win=",d_prob)
-  print("             lean       predictit  sim       polls    sim      HIQR        RCL")
-  for state in states:
-    if swing==0 or (predictit_prob[state]>0.20 and predictit_prob[state]<0.80):
-      sym = uncertainty_symbol(poll[state],undecided[state])
+  if errors is None:
+    print("prob of D win=",d_prob)
+    print("             lean       predictit  sim       polls    sim      HIQR        RCL")
+  else:
+    print("prob of D win=",f3(d_prob),"+-",f3(errors['d_prob']),"  (",n,"trials )")
+    print("             lean       predictit  sim     +-      polls    sim      HIQR        RCL     +-")
+  for state in listed_states(pars,sd):
+    sym = uncertainty_symbol(poll[state],undecided[state])
+    if errors is None:
       print(ps(state),"      ",f1(lean[state]),"     ",f2(predictit_prob[state])," ",f2(prob[state]),"    ",
            f1(poll[state]),sym," ",f1(vote_avg[state])," ",f2(iqr('normal')*ind[state]/2.0),"    ",f2(rcl[state])
-    )
+      )
+    else:
+      print(ps(state),"      ",f1(lean[state]),"     ",f2(predictit_prob[state])," ",f2(prob[state]),f3(errors['prob'][state]),"  ",
+           f1(poll[state]),sym," ",f1(vote_avg[state])," ",f2(iqr('normal')*ind[state]/2.0),"    ",f2(rcl[state]),
+           f3(errors['rcl'][state])
+      )
 
   if joint[0]!='':
     print("joint probabilities:")
     for i in range(2):
       for j in range(2):
-        joint_table[i][j] *= 1.0/n_trials
+        joint_table[i][j] *= 1.0/n
     print("               D in ",ps(joint[1]))
     print("               lose     win")
     for i in range(2):
@@ -164,34 +2654,85 @@ def output(pars,results,sd):
       print(" ",descr,"",ps(joint[0]),f2(joint_table[i][0])," ",f2(joint_table[i][1]))
         
 
-def do_one_trial(dat):
-  (safe_d,safe_r,aa,k,s,dist,tot,c,ind,electoral_votes,lean,tie) = (dat['safe_d'],dat['safe_r'],
-              dat['aa'],dat['k'],dat['s'],dat['dist'],dat['tot'],dat['c'],
-              dat['ind'],dat['electoral_votes'],dat['lean'],dat['tie'])
+def output_races(acc,dat):
+  # Print the results for the senate or house races: who controls each chamber, the probability of D winning each race, and the joint outcomes.
+  (n,r,totals) = (acc['n'],dat['races'],acc['races'])
+  chambers = r['chambers']
+  print("")
+  for chamber in chambers:
+    print(f"{chamber}: prob of D control=",f3(totals['control'][chamber]/n),", mean D seats=",
+          f1(totals['seat_sum'][chamber]/n),"out of",r['total'][chamber],", c=",f1(r['c'][chamber]))
+  print("race         lean    polls    prob")
+  for race in r['seats']:
+    print(ps(race).ljust(10),"",f1(r['lean'][race]),"  ",f1(r['poll'][race]),"  ",f2(totals['race_d_wins'][race]/n))
+  print("joint outcomes:")
+  print("  "+"  ".join(["president"]+chambers))
+  for i in range(len(totals['outcomes'])):
+    bits = [(i>>(len(chambers)-h))&1 for h in range(len(chambers)+1)] # presidency, then each chamber
+    party = ["D" if b else "R" for b in bits]
+    line = "  "+"  ".join([party[0].ljust(9)]+[party[h+1].ljust(len(chambers[h])) for h in range(len(chambers))])+"  "+f3(totals['outcomes'][i]/n)
+    if len(set(party))==1 and sorted(chambers)==['house','senate']:
+      line = line+f"  ({party[0]} trifecta)"
+    print(line)
+
+def listed_states(pars,sd):
+  # The states that are shown in the output. If swing=1, this is only real swing states.
+  result = []
+  for state in sd['states']:
+    p = sd['predictit_prob'][state]
+    if pars['swing']==0 or (p>0.20 and p<0.80):
+      result.append(state)
+  return result
+
+def do_one_trial(dat,rng=random):
+  # One trial, with the results in dicts whose keys are states. The python engine uses one_trial() instead, which is faster.
+  units = unit_lists(dat)
+  states = units[0]
+  x,d,d_win,tip = one_trial(dat,units,rng)
+  t = {'state_d_win':{},'vote':{},'d_win':d_win}
+  for j in range(len(states)):
+    t['vote'][states[j]] = x[j]
+    t['state_d_win'][states[j]] = int(x[j]>0.0)
+  t['bin'] = vote_margin_to_predictit_bin(2*d-electoral_college_size())[0]
+  t['tipping'] = states[tip]
+  return t
+
+def unit_lists(dat):
+  """
+  The inputs for each state, as lists in a fixed order (the order of electoral_votes), so that each trial in the python engine
+  is just a pass over lists, without building any dicts. Returns (states,ev,ind,mu), where mu is the expected margin.
+  """
+  (c,k,ind,electoral_votes,lean) = (dat['c'],dat['k'],dat['ind'],dat['electoral_votes'],dat['lean'])
+  states = list(electoral_votes.keys())
+  return (states,[electoral_votes[state] for state in states],[ind[state] for state in states],
+          [c*(lean[state]+k) for state in states])
+
+def one_trial(dat,units,rng=random):
+  """
+  Simulate one election. Units is from unit_lists(). Returns (x,d,d_win,tip), where x is a list of the margins in the states, d is D's
+  electoral votes, d_win is 1 if D won, and tip is the index of the tipping-point state.
+  """
+  (safe_d,safe_r,aa,dist,tot) = (dat['safe_d'],dat['safe_r'],dat['aa'],dat['dist'],dat['tot'])
+  (states,ev,ind,mu) = units
   d = safe_d
-  pop = aa*bell_curve(dist)
-  x = {}
-  t = {}
-  t['state_d_win'] = {}
-  for state, v in electoral_votes.items():
-    x[state] = bell_to_200_percent_range(pop+ind[state]*bell_curve(dist)+c*(lean[state]+k))
-    if x[state]>0.0:
-      d = d+v
-      t['state_d_win'][state] = 1
-    else:
-      t['state_d_win'][state] = 0
+  pop = aa*bell_curve(dist,rng)
+  x = [0.0]*len(states)
+  for j in range(len(states)):
+    x[j] = bell_to_200_percent_range(pop+ind[j]*bell_curve(dist,rng)+mu[j])
+    if x[j]>0.0:
+      d = d+ev[j]
   tie = (d*2==tot)
   if d>tot*0.5 or (tie and dat['tie']==1):
-    t['d_win'] = 1
+    d_win = 1
   else:
-    t['d_win'] = 0
-  t['vote'] = x
-  t['bin'] = vote_margin_to_predictit_bin(2*d-electoral_college_size())[0]
-  t['tipping'] = tipping_point(safe_d,safe_r,x,electoral_votes,dat['tie'],t['d_win'],2) # 2 means use predictit's definition
-  return t
-
-def guess_national_variability():
-  now = datetime.datetime.now()
+    d_win = 0
+  tip = tipping_point_index(safe_d,safe_r,x,ev,dat['tie'],d_win,2) # 2 means use predictit's definition
+  return (x,d,d_win,tip)
+
+def guess_national_variability(now=None):
+  # The default for A, which depends on the date. If now isn't given, the current date is used.
+  if now is None:
+    now = datetime.datetime.now()
   t = abs((now-datetime.datetime.strptime("11/3/20", '%m/%d/%y')).days) # days until the election
   # See README file for estimate that A=7 in mid-july (111 days), 2.5 (election day). 
   max_a = 7
@@ -224,7 +2765,15 @@ def calibrate_lean_to_percent(poll,lean):
 
   return (c,k)
 
-def state_data(filename,polls_file):
+def state_data(filename,polls_file,safe_file=None):
+  """
+  Read the data about the states that aren't safe from filename (data.csv), their polls from polls_file, and the electoral votes
+  of the safe ones from safe_file, which defaults to safe.csv in the same directory as filename. A state that is split up by
+  congressional district, like maine, is just listed as more than one unit, e.g., me, me-01, and me-02, in whichever file
+  each one belongs in.
+  """
+  if safe_file is None:
+    safe_file = os.path.join(os.path.dirname(filename),'safe.csv')
   electoral_votes = {}
   lean = {}
   predictit_prob = {}
@@ -258,11 +2807,10 @@ def state_data(filename,polls_file):
   # list of states, sorted in order by lean, and secondarily by polls, probability on predictit
   states = list(electoral_votes.keys())
   states.sort(key=lambda s:lean[s]) # rough initial sort
-  states = bubble_sort(states,lean,poll,predictit_prob) # refine the sort; can't do this using python's sort
+  states = sort_states(states,lean,poll,predictit_prob) # refine the sort
 
   # Safe states are those that don't occur in the data file.
-  safe_d =  68 # includes 3 electoral votes from maine, but not ME-02
-  safe_r =  93 # includes 4 electoral votes from nebraska, but not NE-02
+  safe_d,safe_r = safe_electoral_votes(safe_file,electoral_votes)
 
   # Check that the total number of electoral votes is what it should be. 
   tot = safe_d + safe_r
@@ -274,6 +2822,23 @@ def state_data(filename,polls_file):
   return {'electoral_votes':electoral_votes,'lean':lean,'predictit_prob':predictit_prob,'poll':poll,'undecided':undecided,
             'safe_d':safe_d,'safe_r':safe_r,'tot':tot,'states':states}
 
+def safe_electoral_votes(filename,electoral_votes):
+  # Add up the electoral votes of the safe states in each party's column. Returns (safe_d,safe_r).
+  safe = {'d':0,'r':0}
+  with open(filename, newline='') as csv_file:
+    csv_reader = csv.reader(csv_file)
+    next(csv_reader) # titles
+    for row in csv_reader:
+      if len(row)==0:
+        continue
+      state,v,party = (row[0],int(row[1]),row[2].strip().lower())
+      if state in electoral_votes:
+        die(f"{state} is listed both in {filename} and as a state that isn't safe")
+      if not (party in safe):
+        die(f"party for {state} in {filename} should be d or r, not {party}")
+      safe[party] += v
+  return (safe['d'],safe['r'])
+
 # This value doesn't change when there's a census, because
 # it's capped by statute at this value: https://en.wikipedia.org/wiki/United_States_congressional_apportionment
 def electoral_college_size():
@@ -286,6 +2851,16 @@ def sort_order(lean,poll,predictit_prob):
     p = poll
   return (lean,p,predictit_prob)  
 
+def sort_states(orig,lean,polls,prob):
+  """
+  Sort the states in the order defined by cmp(). The comparison isn't always transitive, because polls may be missing, so
+  python's sort isn't guaranteed to give an order in which every pair of neighbors is in the right order. We therefore follow it
+  with bubble_sort(), which normally only needs to make a single pass to check this, so that the whole thing takes
+  n log n time rather than n^2 for a long list, such as one with every congressional district.
+  """
+  states = sorted(orig,key=functools.cmp_to_key(lambda s1,s2:-cmp((lean[s1],polls[s1],prob[s1]),(lean[s2],polls[s2],prob[s2]))))
+  return bubble_sort(states,lean,polls,prob)
+
 def bubble_sort(orig,lean,polls,prob):
   """
   For efficiency, we do this after an initial, more efficient sort using python's sort function. The problem
@@ -343,14 +2918,20 @@ def tipping_point(safe_d,safe_r,margins,electoral_votes,tie,d_win,tip_definition
   d_win=0 if R won, 1 if D won
   tip_definition=1 means what really happens based on tie, 2 means predictit's definition
   """
+  states = list(margins.keys())
+  j = tipping_point_index(safe_d,safe_r,[margins[state] for state in states],[electoral_votes[state] for state in states],
+                          tie,d_win,tip_definition)
+  return states[j]
+
+def tipping_point_index(safe_d,safe_r,margins,electoral_votes,tie,d_win,tip_definition):
+  # Does the same thing as tipping_point(), but the margins and electoral votes are lists, and it returns the index of the state.
   if d_win:
     sgn = -1
     winning_votes = safe_d
   else:
     sgn = 1
     winning_votes = safe_r
-  states = list(margins.keys())
-  states.sort(key=lambda state:sgn*margins[state]) # for D win, this starts from the safest blue states, like california
+  order = sorted(range(len(margins)),key=lambda j:sgn*margins[j]) # for D win, this starts from the safest blue states, like california
   if tip_definition==1:
     if (tie==0 and d_win==0) or (tie==1 and d_win==1):
       # Winner would win with a tie
@@ -359,33 +2940,57 @@ def tipping_point(safe_d,safe_r,margins,electoral_votes,tie,d_win,tip_definition
       needed = int(electoral_college_size()/2+1)
   else:
     needed = int(electoral_college_size()/2+1)
-  for state in states:
+  for j in order:
     before = winning_votes
-    after = before+electoral_votes[state]
+    after = before+electoral_votes[j]
     if before<needed and after>=needed:
-      return state
-    winning_votes += electoral_votes[state]
+      return j
+    winning_votes += electoral_votes[j]
   raise Exception("tipping point not found")
 
+def tipping_points_array(safe_d,safe_r,x,ev,tie,d_win,tip_definition):
+  """
+  Does the same thing as tipping_point(), but for a whole block of trials at once. The margins x have one row per trial and
+  one column per state, ev is the array of electoral votes for the states, and d_win is a boolean array with one element
+  per trial. Returns an array giving the column of the tipping-point state for each trial.
+  For each trial, the states are sorted starting from the winner's safest, the electoral votes are added up along the
+  sorted order, and the tipping point is the first state at which the total reaches the number needed.
+  """
+  sgn = np.where(d_win,-1.0,1.0)
+  order = np.argsort(sgn[:,None]*x,axis=1,kind='stable') # stable, like python's sort in tipping_point()
+  votes = np.where(d_win,safe_d,safe_r)[:,None]+np.cumsum(ev[order],axis=1) # winner's total after adding each state
+  majority = int(electoral_college_size()/2+1)
+  needed = np.full(len(d_win),majority)
+  if tip_definition==1:
+    # Winner would win with a tie.
+    needed = np.where(((tie==0) & ~d_win) | ((tie==1) & d_win),electoral_college_size()/2,majority)
+  reached = (votes>=needed[:,None])
+  if not np.all(reached[:,-1]):
+    raise Exception("tipping point not found")
+  first = np.argmax(reached,axis=1)
+  if np.any(votes[np.arange(len(first)),first]-ev[order[np.arange(len(first)),first]]>=needed):
+    raise Exception("tipping point not found") # winner had enough votes even without any of these states
+  return order[np.arange(len(first)),first]
+
 def correlation_to_weight(rho):
   return math.sqrt(rho**-0.5-1)
 
-def bell_curve(dist):
-  # See notes about how choice of dist affects A.
+def bell_curve(dist,rng=random):
+  # See notes about how choice of dist affects A. The rng can be the random module or a random.Random object.
   if dist=='normal':
-    return normal()
+    return normal(rng)
   if dist=='cauchy':
-    return cauchy()
+    return cauchy(rng)
   die("illegal value of dist in bell_curve")
 
-def cauchy():
+def cauchy(rng=random):
   """
   Generate a Cauchy random variable with center 0 and the same interquartile range as a standard normal curve.
   Use this rather than a normal curve to get fatter tails and more spice.
   https://math.stackexchange.com/questions/484395/how-to-generate-a-cauchy-random-variable
   https://en.wikipedia.org/wiki/Cauchy_distribution
   """
-  y = random.random() # uniform
+  y = rng.random() # uniform
   scale = iqr('normal')/iqr('cauchy')
   return scale*math.tan(math.pi*(y-0.5)) # this is different from the atan(...) applied elsewhere
 
@@ -423,8 +3028,49 @@ def bell_to_200_percent_range(x):
       return 100.0
     return x
 
-def normal():
-  return random.normalvariate(0,1)
+def bell_curve_array(dist,rng,shape):
+  """
+  Array version of bell_curve(), using a numpy random number generator.
+  """
+  if dist=='normal':
+    return rng.standard_normal(shape)
+  if dist=='cauchy':
+    scale = iqr('normal')/iqr('cauchy')
+    return scale*np.tan(np.pi*(rng.random(shape)-0.5))
+  die("illegal value of dist in bell_curve_array")
+
+def inverse_normal_cdf_array(u):
+  """
+  Inverse of the cumulative distribution function of the standard normal distribution, for an array of values of u in (0,1).
+  This is Peter Acklam's rational approximation, which has a relative error less than 1.2x10^-9. Numpy doesn't have this
+  built in, and statistics.NormalDist().inv_cdf() only does one number at a time.
+  """
+  a = [-3.969683028665376e+01,2.209460984245205e+02,-2.759285104469687e+02,1.383577518672690e+02,-3.066479806614716e+01,2.506628277459239e+00]
+  b = [-5.447609879822406e+01,1.615858368580409e+02,-1.556989798598866e+02,6.680131188771972e+01,-1.328068155288572e+01]
+  c = [-7.784894002430293e-03,-3.223964580411365e-01,-2.400758277161838e+00,-2.549732539343734e+00,4.374664141464968e+00,2.938163982698783e+00]
+  d = [7.784695709041462e-03,3.224671290700398e-01,2.445134137142996e+00,3.754408661907416e+00]
+  u = np.asarray(u,dtype=float)
+  u_low = 0.02425
+  x = np.empty_like(u)
+  lo = (u<u_low)
+  hi = (u>1.0-u_low)
+  mid = ~(lo | hi)
+  q = np.sqrt(-2.0*np.log(np.where(lo,u,0.5)))
+  x[lo] = ((((((c[0]*q+c[1])*q+c[2])*q+c[3])*q+c[4])*q+c[5])/((((d[0]*q+d[1])*q+d[2])*q+d[3])*q+1.0))[lo]
+  q = np.sqrt(-2.0*np.log(np.where(hi,1.0-u,0.5)))
+  x[hi] = -((((((c[0]*q+c[1])*q+c[2])*q+c[3])*q+c[4])*q+c[5])/((((d[0]*q+d[1])*q+d[2])*q+d[3])*q+1.0))[hi]
+  q = u-0.5
+  r = q*q
+  x[mid] = ((((((a[0]*r+a[1])*r+a[2])*r+a[3])*r+a[4])*r+a[5])*q/(((((b[0]*r+b[1])*r+b[2])*r+b[3])*r+b[4])*r+1.0))[mid]
+  return x
+
+def bell_to_200_percent_range_array(x):
+  # array version of bell_to_200_percent_range()
+  n = 100.0/(math.pi/2)
+  return n*np.arctan(x/n)
+
+def normal(rng=random):
+  return rng.normalvariate(0,1)
 
 def die(message):
   sys.exit(message)
@@ -497,6 +3143,8 @@ def ps(state):
     return "NE-02"
   if state=="nat":
     return state
+  if re.search("-",state):
+    return state.upper() # a congressional district, like me-02
   return state.upper()+"   "
 
 def get_defaults_from_file(file):
@@ -507,8 +3155,10 @@ def get_defaults_from_file(file):
         pars = get_one_par(pars,line,f"reading defaults from file {file}")
   return pars
 
-def get_command_line_pars(pars):
-  for arg in sys.argv[1:]:
+def get_command_line_pars(pars,args=None):
+  if args is None:
+    args = sys.argv[1:]
+  for arg in args:
     pars = get_one_par(pars,arg,"reading command-line parameters")
   return pars
 
@@ -518,11 +3168,16 @@ def get_one_par(pars,par,context_for_errors):
     p,v = capture.group(1,2)
     if p in parameter_names():
       if p=='rho':
-        die("Setting the rho parameters can only be done by editing the source code.")
-      if p=='joint':
+        rho = [float(x) for x in v.split(',')]
+        if len(rho)!=3:
+          die(f"rho should be three numbers separated by commas, for most states, for fl, and for nv, {context_for_errors}")
+        pars['rho'] = tuple(rho)
+      elif p=='joint':
         capture = re.search("(.*),(.*)",v)
         j1,j2 = capture.group(1,2)
         pars['joint'] = (j1,j2)
+      elif re.search("^sweep_",p):
+        pars[p] = parse_sweep_values(v,parameter_types()[p[6:]])
       else:
         pars[p] = parameter_types()[p](v)
     else:
@@ -531,6 +3186,20 @@ def get_one_par(pars,par,context_for_errors):
     die(f"syntax error in parameter: '{par}', {context_for_errors}")
   return pars
 
+def parse_sweep_values(v,type):
+  """
+  Values for a parameter sweep can be given either as a list, like 2,4,6 or normal,cauchy, or as a range lo:hi:step, like
+  2:6:0.5, which includes both lo and hi.
+  """
+  capture = re.search("^(.*):(.*):(.*)$",v)
+  if capture:
+    lo,hi,step = [float(x) for x in capture.group(1,2,3)]
+    if step<=0.0:
+      die(f"step must be positive in sweep values {v}")
+    n = int(math.floor((hi-lo)/step+1.0e-9))
+    return [type(str(lo+i*step)) for i in range(n+1)]
+  return [type(x) for x in v.split(",")]
+
 def parameter_names():
   return list(parameter_types().keys())
 
@@ -540,7 +3209,10 @@ def parameter_types():
   s = lambda x:x # string
   b = i # boolean, treated as int
   t = s # tuple, requires some postprocessing
-  return {'a':f,'k':f,'s':f,'dist':s,'n_trials':i,'joint':t,'rho':None,'swing':b,'tie':i}
+  return {'a':f,'k':f,'s':f,'dist':s,'n_trials':i,'joint':t,'rho':None,'swing':b,'tie':i,'engine':s,'workers':i,'seed':i,'se':f,'tilt':f,'tilt_states':b,'cache':b,
+          'sweep_a':t,'sweep_k':t,'sweep_s':t,'sweep_dist':t,
+          'store':s,'store_margins':b,'query':s,'given':s,'pairs':b,'correlation':s,'timeline':s,'timeline_polls':s,'profile':b,'profile_json':s,'races':s,'sampling':s,'calibrate':b,'predictit_nat':f,'sensitivity':b,
+          'checkpoint':s,'extend':i,'replay':i,'scenarios':s}
 
 def set_is_empty(s):
   return s == set()
@@ -559,4 +3231,5 @@ def mean_abs_dev(l):
     sum += abs(x-avg)
   return sum/len(l)
 
-main()
+if __name__=='__main__':
+  main() # guarded so that worker processes can import this file without running the simulation
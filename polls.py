@@ -2,8 +2,9 @@
 
 # parse a csv file in the format supplied by https://projects.fivethirtyeight.com/polls-page/president_polls.csv
 # output a CSV file consisting only of polls within the last 60 days that fivethirtyeight rates at least B and that are not partisan
+# polls.py timeline=8/1/20:11/3/20 instead outputs the averages as they would have been on each of those dates; see README
 
-import math,sys,csv,re,copy,datetime,statistics
+import sys,csv,re,datetime,io,os,json,hashlib,functools
 
 def minimum_grade():
   return grade_to_number("B/C") # minimum letter grade for pollsters
@@ -19,131 +20,354 @@ def main():
   now = datetime.datetime.now()
   infile = 'president_polls.csv'
   outfile = 'polls.csv'
+  checkpoint_file = 'polls_checkpoint.json'
   candidates = ("biden","trump")
-  i_state = 0
-  i_answer = 5
-  i_pct = 6
-  i_pollster = 7
-  with open(infile, newline='') as csv_file:
-    csv_reader = csv.reader(csv_file)
-    titles = True
-    raw_rows = []
-    for row in csv_reader:
-      if titles:
-        titles = False
-        col_map = {}
-        for key in cols():
-          col_map[key] = row.index(key) # throws ValueError if not found
-        #print("columns: ",col_map)
+  dates = command_line_timeline()
+  if not (dates is None):
+    write_timeline(infile,'polls_timeline.csv',candidates,dates)
+    return
+  checkpoint = read_checkpoint(checkpoint_file,candidates)
+  region = new_data_region(infile,checkpoint)
+  if region is None:
+    checkpoint = None # couldn't reuse the old results, so start over from scratch
+    region = new_data_region(infile,None)
+  header,start,end,data_bytes,data_hash = region
+  by_state = pair_polls(filtered_rows(infile,header,start,end,candidates),candidates)
+  if checkpoint is None:
+    print(f"Processing all of {infile}")
+    old = {}
+  else:
+    print(f"Processing {end-start} bytes of new data at the top of {infile}")
+    old = checkpoint['by_state']
+  # For each state, the most recent poll by each pollster. New polls come first, since the input file is in reverse chronological order.
+  latest = {}
+  for state in set(by_state.keys()) | set(old.keys()):
+    latest[state] = first_poll_by_each_pollster(by_state.get(state,[])+old.get(state,[]))
+  states = list(latest.keys())
+  states.sort()
+  with open(outfile,'w') as f:
+    for state in states:
+      results = []
+      details = ''
+      for poll in latest[state]:
+        pollster,date,pct,undecided = poll
+        age = (now-parse_date(date)).days
+        if age<max_age():
+          details = details + f"    {date} {pct} undecided={undecided} {pollster}\n"
+          weight = 2.0**(-age/half_life())
+          results.append([pct,undecided,weight])
+      if len(results)==0:
+        continue
+      sum_poll = 0.0
+      sum_undecided = 0.0
+      sum_weight = 0.0
+      for r in results:
+        p,u,w = r
+        sum_poll += p*w
+        sum_undecided += u*w
+        sum_weight += w
+      avg = sum_poll/sum_weight
+      und = sum_undecided/sum_weight
+      print("state=",state,", avg=",f1(avg),", undecided=",f1(und))
+      print(details)
+      f.write(f'{state.lower()},{f1(avg)},{f1(und)}\n')
+  write_checkpoint(checkpoint_file,candidates,header,data_bytes,data_hash,latest)
+  print(f"Output written to {outfile}")
+
+def command_line_timeline():
+  # Returns a list of dates if the command line has timeline=..., otherwise None.
+  dates = None
+  for arg in sys.argv[1:]:
+    capture = re.search("^timeline=(.*)$",arg)
+    if not capture:
+      die(f"illegal command-line argument {arg}, the only one allowed is timeline=...")
+    parts = capture.group(1).split(':')
+    if not (len(parts) in [2,3]):
+      die("timeline should be a range of dates like 8/1/20:11/3/20, or 8/1/20:11/3/20:7 to do every 7th day")
+    first,last = (parse_date(parts[0]),parse_date(parts[1]))
+    step = 1
+    if len(parts)==3:
+      step = int(parts[2])
+    dates = [first+datetime.timedelta(days=d) for d in range(0,(last-first).days+1,step)]
+  return dates
+
+def write_timeline(infile,outfile,candidates,dates):
+  """
+  Write the poll averages as they would have been calculated on each of the given dates, using only the polls that had come out
+  by that date. The output has a header line and then lines of the form date,state,avg,undecided, with one line for each date and
+  state that had recent enough polls.
+  """
+  with open(infile,'rb') as f:
+    header = next(csv.reader([f.readline().decode('utf-8')]))
+    start = f.tell()
+    f.seek(0,io.SEEK_END)
+    end = f.tell()
+  by_state = pair_polls(filtered_rows(infile,header,start,end,candidates),candidates)
+  states = list(by_state.keys())
+  states.sort()
+  with open(outfile,'w') as f:
+    f.write("date,state,poll,undecided\n")
+    averages = {}
+    for state in states:
+      averages[state] = rolling_averages(by_state[state],dates)
+    for i in range(len(dates)):
+      date = dates[i].strftime('%m/%d/%y')
+      for state in states:
+        if not (averages[state][i] is None):
+          avg,und = averages[state][i]
+          f.write(f'{date},{state.lower()},{f1(avg)},{f1(und)}\n')
+  print(f"Averages for {len(dates)} dates written to {outfile}")
+
+def rolling_averages(polls,dates):
+  """
+  Given all the polls for one state, in the order returned by pair_polls(), calculate the same weighted averages as main() would
+  have calculated on each of the given dates, which must be in increasing order. Returns a list with an element (avg,undecided) for
+  each date, or None if there were no usable polls on that date.
+  We step through the days one at a time, keeping running sums of the weighted polls. Since the weights are exponentials, moving
+  forward by one day just means multiplying the sums by a constant factor. A poll's weighted values are added in on the day it
+  comes out and subtracted out on the day it gets too old, or when the same pollster comes out with a newer poll.
+  """
+  result = [None]*len(dates)
+  if len(dates)==0:
+    return result
+  decay = 2.0**(-1.0/half_life())
+  day0 = dates[0].toordinal()-max_age() # far enough back that all the polls that count on the first date are included
+  # Make a list of polls coming out on each day. For the same pollster on the same day, the one listed first in the file is
+  # the one used in main(), so it has to be added last.
+  new_polls = {}
+  for poll in reversed(polls):
+    pollster,date,pct,undecided = poll
+    day = parse_date(date).toordinal()
+    if day>=day0 and day<=dates[-1].toordinal():
+      new_polls.setdefault(day,[]).append(poll)
+  active = {} # for each pollster, (day,pct,undecided) of its most recent poll
+  sum_poll,sum_undecided,sum_weight = (0.0,0.0,0.0)
+  i = 0
+  for day in range(day0,dates[-1].toordinal()+1):
+    sum_poll,sum_undecided,sum_weight = (sum_poll*decay,sum_undecided*decay,sum_weight*decay)
+    to_remove = []
+    for pollster in active:
+      if day-active[pollster][0]>=max_age():
+        to_remove.append(pollster)
+    for poll in new_polls.get(day,[]):
+      if poll[0] in active:
+        to_remove.append(poll[0])
+    for pollster in to_remove:
+      if pollster in active:
+        old_day,pct,undecided = active.pop(pollster)
+        w = 2.0**(-(day-old_day)/half_life())
+        sum_poll,sum_undecided,sum_weight = (sum_poll-pct*w,sum_undecided-undecided*w,sum_weight-w)
+    for poll in new_polls.get(day,[]):
+      pollster,date,pct,undecided = poll
+      if pollster in active:
+        old_day,old_pct,old_undecided = active.pop(pollster) # two polls by the same pollster on the same day
+        sum_poll,sum_undecided,sum_weight = (sum_poll-old_pct,sum_undecided-old_undecided,sum_weight-1.0)
+      active[pollster] = (day,pct,undecided)
+      sum_poll,sum_undecided,sum_weight = (sum_poll+pct,sum_undecided+undecided,sum_weight+1.0)
+    if len(active)==0:
+      sum_poll,sum_undecided,sum_weight = (0.0,0.0,0.0) # don't let rounding errors build up
+    while i<len(dates) and dates[i].toordinal()==day:
+      if len(active)>0:
+        result[i] = (sum_poll/sum_weight,sum_undecided/sum_weight)
+      i += 1
+  return result
+
+def filtered_rows(infile,header,start,end,candidates):
+  """
+  Generator that reads the rows of infile that lie between byte offsets start and end, and yields only the ones we
+  care about, reduced to the columns we use: [state,grade,office,date,partisan,answer,pct,pollster].
+  """
+  col_map = {}
+  for key in cols():
+    col_map[key] = header.index(key) # throws ValueError if not found
+  min_grade = minimum_grade()
+  i_state,i_grade,i_office,i_date,i_partisan,i_answer,i_pct,i_pollster = [col_map[key] for key in cols()]
+  with open(infile,'rb') as raw:
+    raw.seek(start)
+    lines = io.TextIOWrapper(io.BufferedReader(LimitedReader(raw,end-start)),newline='')
+    for row in csv.reader(lines):
+      answer = row[i_answer].lower()
+      if not (answer in candidates): # cheapest test, and rules out most rows, so do it first
         continue
-      d = unpack_row(row,col_map,["state","fte_grade","office_type","end_date","partisan","answer","pct","pollster"])
-      state,grade,office,date,partisan,answer,pct,pollster = d # if changing this list, change i_answer and i_state, and also change similar list later
+      state,grade,office,date,partisan,pct,pollster = (row[i_state],row[i_grade],row[i_office],row[i_date],row[i_partisan],
+                 row[i_pct],row[i_pollster])
       if  (not re.search(r"\w",state)) or (not re.search(r"\w",grade)) or (not re.search(r"president",office,re.IGNORECASE)):
         continue
-      if (not re.search(r"\d",date)) or (not re.search(r"\w",answer)) or (not re.search(r"\d",pct)):
+      if (not re.search(r"\d",date)) or (not re.search(r"\d",pct)):
         continue
       if re.search(r"\w",partisan): # this is blank for polls from the primaries
         continue
-      if grade_to_number(grade)<minimum_grade():
+      if grade_to_number(grade)<min_grade:
         continue
-      if not (answer.lower() in candidates):
-        continue
-      d[i_answer] = answer.lower() # candidate
-      d[i_state] = state_to_abbrev(state)
-      raw_rows.append(d)
-    polls = {}
-    # sort into groups representing single polls
-    for d in raw_rows:
-      state,grade,office,date,partisan,answer,pct,pollster = d
-      key = state+","+date+","+pollster
-      if key in polls:
-        polls[key].append(d)
-      else:
-        polls[key] = [d]
-    # once in a while we get two polls from the same pollster, with the same end date, for the same state:
-    new_polls = {}
-    for key in polls:
-      x = polls[key]
-      if len(x)==2:
-        new_polls[key] = x
-      else:
-        for i in range(int(len(x)/2)):
-          new_polls[key+","+str(i)] = [x[i],x[i+1]]
-    polls = new_polls
-    # extract results that are head-to-head match-ups of the two candidates we care about, and sort by state
-    by_state = {}
-    for key in polls:
-      d1,d2 = polls[key]
-      # get them in canonical order
-      if d1[i_answer]==candidates[1] and d2[i_answer]==candidates[0]:
-        temp = copy.deepcopy(d1)
-        d1 = d2
-        d2 = temp
-      if d1[i_answer]==candidates[0] and d2[i_answer]==candidates[1]:
-        state,grade,office,date,partisan,answer,pct,pollster = d1
-        pct = float(d1[i_pct])-float(d2[i_pct])
-        undecided = 100.0-(float(d1[i_pct])+float(d2[i_pct]))
-        if not (state in by_state):
-          by_state[state] = []
-        by_state[state].append({'raw':d1,'date':date,'pct':pct,'undecided':undecided})
-    states = list(by_state.keys())
-    states.sort()
-    with open(outfile,'w') as f:
-      for state in states:
-        results = []
-        pollsters = [] # only take the first poll by a given pollster on a given date
-        details = ''
-        for poll in by_state[state]: # dict with keys raw, date, pct
-          age = (now-datetime.datetime.strptime(poll['date'], '%m/%d/%y')).days
-          #pkey = poll['raw'][i_pollster]+","+poll['date']
-          # ... done this way, we use multiple polls from the same pollster that are on different dates
-          pkey = poll['raw'][i_pollster]
-          # ... done this way, we use the first-listed poll by any pollster, which is the most recent; the input file is in reverse chronological order
-          if pkey in pollsters:
-            continue # only take the first poll by a given pollster on a given date
-          pollsters.append(pkey)
-          if age<max_age():
-            details = details + f"    {poll['date']} {poll['pct']} undecided={poll['undecided']} {poll['raw'][i_pollster]}\n"
-            weight = 2.0**(-age/half_life())
-            results.append([poll['pct'],poll['undecided'],weight])
-        if len(results)==0:
-          continue
-        sum_poll = 0.0
-        sum_undecided = 0.0
-        sum_weight = 0.0
-        for r in results:
-          p,u,w = r
-          sum_poll += p*w
-          sum_undecided += u*w
-          sum_weight += w
-        avg = sum_poll/sum_weight
-        und = sum_undecided/sum_weight
-        print("state=",state,", avg=",f1(avg),", undecided=",f1(und))
-        print(details)
-        f.write(f'{state.lower()},{f1(avg)},{f1(und)}\n')
-  print(f"Output written to {outfile}")
+      yield [state_to_abbrev(state),grade,office,date,partisan,answer,pct,pollster]
 
-def unpack_row(row,col_map,keys):
+def pair_polls(rows,candidates):
+  """
+  Group the rows into head-to-head match-ups of the two candidates, sorted by state. Returns a dict whose keys are states, and whose values are
+  lists of polls, each of the form [pollster,date,pct,undecided], in the same order as in the input file.
+  """
+  i_answer = 5
+  i_pct = 6
+  polls = {}
+  # sort into groups representing single polls
+  for d in rows:
+    state,grade,office,date,partisan,answer,pct,pollster = d
+    key = state+","+date+","+pollster
+    if key in polls:
+      polls[key].append(d)
+    else:
+      polls[key] = [d]
+  # once in a while we get two polls from the same pollster, with the same end date, for the same state:
+  new_polls = {}
+  for key in polls:
+    x = polls[key]
+    if len(x)==2:
+      new_polls[key] = x
+    else:
+      for i in range(int(len(x)/2)):
+        new_polls[key+","+str(i)] = [x[i],x[i+1]]
+  polls = new_polls
+  # extract results that are head-to-head match-ups of the two candidates we care about, and sort by state
+  by_state = {}
+  for key in polls:
+    d1,d2 = polls[key]
+    # get them in canonical order
+    if d1[i_answer]==candidates[1] and d2[i_answer]==candidates[0]:
+      d1,d2 = (d2,d1)
+    if d1[i_answer]==candidates[0] and d2[i_answer]==candidates[1]:
+      state,grade,office,date,partisan,answer,pct,pollster = d1
+      pct = float(d1[i_pct])-float(d2[i_pct])
+      undecided = 100.0-(float(d1[i_pct])+float(d2[i_pct]))
+      if not (state in by_state):
+        by_state[state] = []
+      by_state[state].append([pollster,date,pct,undecided])
+  return by_state
+
+def first_poll_by_each_pollster(polls):
+  # We use the first-listed poll by any pollster, which is the most recent; the input file is in reverse chronological order.
   result = []
-  for key in keys:
-    col = col_map[key]
-    result.append(row[col])
+  pollsters = set()
+  for poll in polls:
+    if poll[0] in pollsters:
+      continue
+    pollsters.add(poll[0])
+    result.append(poll)
   return result
 
+def new_data_region(infile,checkpoint):
+  """
+  Figure out what part of infile needs to be processed. New polls are added at the top of the file by fivethirtyeight,
+  so if the checkpoint shows that the end of the file is exactly the data we processed last time, we only need to
+  process the rows before that. Returns (header,start,end,data_bytes,data_hash), where header is the list of column titles,
+  start and end are the byte offsets of the rows to process, and data_bytes and data_hash describe all the data after the header,
+  to be saved in the new checkpoint. If checkpoint is None, the whole file is processed. Returns None if the checkpoint
+  doesn't match the file.
+  """
+  with open(infile,'rb') as f:
+    header_line = f.readline()
+    data_start = f.tell()
+    f.seek(0,io.SEEK_END)
+    size = f.tell()
+    data_bytes = size-data_start
+    header = next(csv.reader([header_line.decode('utf-8')]))
+    if checkpoint is None:
+      old_start = size
+    else:
+      if header!=checkpoint['header'] or checkpoint['data_bytes']>data_bytes:
+        return None
+      old_start = size-checkpoint['data_bytes']
+    # One pass through the data, hashing all of it, and separately hashing the part that should match the old data.
+    all_hash = hashlib.sha256()
+    old_hash = hashlib.sha256()
+    f.seek(data_start)
+    pos = data_start
+    while pos<size:
+      chunk = f.read(min(1<<20,size-pos))
+      all_hash.update(chunk)
+      if pos+len(chunk)>old_start:
+        old_hash.update(chunk[max(0,old_start-pos):])
+      pos += len(chunk)
+  if not (checkpoint is None):
+    if old_hash.hexdigest()!=checkpoint['data_hash']:
+      return None
+    if old_start>data_start:
+      with open(infile,'rb') as f:
+        f.seek(old_start-1)
+        if f.read(1)!=b'\n':
+          return None # the old data doesn't start at the beginning of a line, so the match was a coincidence
+  return (header,data_start,old_start,data_bytes,all_hash.hexdigest())
+
+class LimitedReader(io.RawIOBase):
+  # Wraps a binary file so that reading stops after a certain number of bytes.
+  def __init__(self,f,n):
+    self.f = f
+    self.remaining = n
+  def readable(self):
+    return True
+  def readinto(self,b):
+    n = min(len(b),self.remaining)
+    if n<=0:
+      return 0
+    data = self.f.read(n)
+    b[:len(data)] = data
+    self.remaining -= len(data)
+    return len(data)
+
+def checkpoint_settings(candidates):
+  # If any of these change, the old checkpoint can't be used.
+  return {'version':1,'candidates':list(candidates),'minimum_grade':minimum_grade(),'cols':cols()}
+
+def read_checkpoint(filename,candidates):
+  """
+  The checkpoint file records what part of the input file was already processed last time, and, for each state, the most recent
+  poll by each pollster in that data. Returns None if there is no usable checkpoint.
+  """
+  try:
+    with open(filename) as f:
+      checkpoint = json.load(f)
+  except (OSError,ValueError):
+    return None
+  if checkpoint.get('settings')!=checkpoint_settings(candidates):
+    return None
+  return checkpoint
+
+def write_checkpoint(filename,candidates,header,data_bytes,data_hash,latest):
+  checkpoint = {'settings':checkpoint_settings(candidates),'header':header,'data_bytes':data_bytes,'data_hash':data_hash,'by_state':latest}
+  temp = filename+".temp"
+  with open(temp,'w') as f:
+    json.dump(checkpoint,f)
+  os.replace(temp,filename) # so that an interrupted run can't leave a half-written checkpoint
+
+@functools.lru_cache(maxsize=None)
+def parse_date(date):
+  return datetime.datetime.strptime(date,'%m/%d/%y')
+
 def cols():
   return ["state","fte_grade","office_type","end_date","partisan","answer","pct","pollster"]
 
 def grade_to_number(grade):
   # convert letter grade to a number, higher being better
+  table = grade_table()
+  if grade.lower() in table:
+    return table[grade.lower()]
+  raise Exception(f"unrecognized grade {grade}")
+
+@functools.lru_cache(maxsize=None)
+def grade_table():
+  # Lookup table for grade_to_number(), built only once.
   pats = ["A+","A","A-","B+","B","B-","A/B","C+","C","C-","B/C","D+","D","D-","C/D","D/F","F"]
   # grades like B/C are given to pollsters with not much of a track record, the ones shown with dotted circles, so put them low down
   n = len(pats)
+  table = {}
   for i in range(n):
-    if grade.lower()==pats[i].lower():
-      return n-i
-  raise Exception(f"unrecognized grade {grade}")
+    table[pats[i].lower()] = n-i
+  return table
 
 def state_to_abbrev(name):
+  return state_abbrev_table()[name]
+
+@functools.lru_cache(maxsize=None)
+def state_abbrev_table():
   # https://gist.github.com/rogerallen/1583593 , public domain
   return {
     'Alabama': 'AL',
@@ -205,7 +429,10 @@ def state_to_abbrev(name):
     'Nebraska CD-2': 'NE-02',
     'Maine CD-1': 'ME-01',
     'Maine CD-2': 'ME-02'
-  }[name]
+  }
+
+def die(message):
+  sys.exit(message)
 
 def f1(x):
   if x is None:
@@ -213,6 +440,7 @@ def f1(x):
   else:
     return ("%5.1f") % x
 
-main()
+if __name__=='__main__':
+  main()
 
 
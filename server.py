@@ -0,0 +1,137 @@
+#!/bin/python3
+
+# Keep a big set of simulated elections in memory, and answer questions about them over http, e.g.:
+#   python3 server.py port=8000 n_trials=1000000
+#   curl 'localhost:8000/prob?event=!nat&given=!pa'
+# Inside an event, & has to be written as %26 so that it isn't taken as the separator between query parameters.
+# See README for details.
+
+import sys,json,re,threading,collections,urllib.parse,http.server
+
+import election
+
+def main():
+  port,args = server_args(sys.argv[1:])
+  election.parameters('defaults.txt',args) # check for errors in the parameters before starting
+  Handler.base_args = args
+  server = http.server.ThreadingHTTPServer(('127.0.0.1',port),Handler)
+  print(f"Listening on http://127.0.0.1:{port}/")
+  server.serve_forever()
+
+def server_args(argv):
+  # Separate port=... from the parameters that are passed along to the simulation.
+  port = 8000
+  args = []
+  for arg in argv:
+    capture = re.search("^port=(.*)$",arg)
+    if capture:
+      port = int(capture.group(1))
+    else:
+      args.append(arg)
+  return (port,args)
+
+def max_pools():
+  return 4 # number of sets of trials, with different parameters, that are kept in memory at once
+
+pools = collections.OrderedDict() # key -> trials, in order of least to most recently used
+in_flight = {} # key -> event that is set when the trials that are being simulated for that key are ready
+pools_lock = threading.Lock() # protects pools and in_flight
+
+def get_trials(args):
+  """
+  Get the simulated trials for these parameters, running the simulation only if they aren't already in memory. The key
+  is the same one used by election.py's cache, so it changes whenever the parameters or the contents of the data files change.
+  If store=... is given, the trials are read from a trial store written by election.py, and the other parameters have no effect.
+  The lock is only held while looking things up, not during the simulation, so that a slow request doesn't hold up ones whose
+  trials are already in memory. If another request is already simulating the same trials, we wait for it rather than doing them twice.
+  """
+  pars = election.parameters('defaults.txt',args)
+  if pars['store']!='':
+    key = election.cache_key(pars,[pars['store']+'.json'])
+  else:
+    key = election.cache_key(pars,election.input_files(pars))
+  while True:
+    with pools_lock:
+      if key in pools:
+        pools.move_to_end(key)
+        return pools[key]
+      ready = in_flight.get(key)
+      if ready is None:
+        ready = threading.Event()
+        in_flight[key] = ready
+        break
+    ready.wait() # then look again, since the trials may not be there if the simulation failed
+  try:
+    trials = make_trials(pars)
+    with pools_lock:
+      pools[key] = trials
+      while len(pools)>max_pools():
+        pools.popitem(last=False)
+  finally:
+    with pools_lock:
+      del in_flight[key]
+    ready.set()
+  return trials
+
+def make_trials(pars):
+  if pars['store']!='':
+    return election.open_trial_store(pars['store'])
+  dat = election.setup(pars,'data.csv','polls.csv')[1]
+  seed = pars['seed']
+  if seed==0:
+    seed = None
+  return election.simulate_outcomes(dat,pars['n_trials'],seed)
+
+def answer(path,query):
+  """
+  Answer one request. The path says what kind of question it is, and query is a dict of query parameters. Any query parameter
+  that isn't part of the question is taken as a parameter for the simulation, e.g., a=3, overriding the ones given on the command line.
+  """
+  question_keys = {'/prob':['event','given'],'/joint':['event1','event2'],'/summary':[]}
+  if not (path in question_keys):
+    raise ValueError(f"unknown request {path}, should be one of {list(question_keys.keys())}")
+  args = list(Handler.base_args)
+  for key in query:
+    if not (key in question_keys[path]):
+      args.append(key+"="+query[key])
+  trials = get_trials(args)
+  n_trials = trials['n_trials']
+  if path=='/prob':
+    if not ('event' in query):
+      raise ValueError("missing event")
+    p,se,n = election.probability(trials,query['event'],query.get('given'))
+    return {'event':query['event'],'given':query.get('given'),'prob':p,'se':se,'n_given':n,'n_trials':n_trials}
+  if path=='/joint':
+    e1,e2 = (query.get('event1','nat'),query.get('event2','nat'))
+    table = [[None,None],[None,None]]
+    for i in range(2):
+      for j in range(2):
+        table[i][j] = election.probability(trials,f"{'' if i else '!'}({e1}) & {'' if j else '!'}({e2})")[0]
+    return {'event1':e1,'event2':e2,'table':table,'n_trials':n_trials,
+            'note':'table[i][j] is the probability that event1 is i and event2 is j, where 0 means false and 1 means true'}
+  result = {'d_prob':election.probability(trials,'nat')[0],'prob':{},'n_trials':n_trials}
+  for state in trials['states']:
+    result['prob'][state] = election.probability(trials,state)[0]
+  return result
+
+class Handler(http.server.BaseHTTPRequestHandler):
+  base_args = []
+
+  def do_GET(self):
+    url = urllib.parse.urlsplit(self.path)
+    query = dict(urllib.parse.parse_qsl(url.query,keep_blank_values=True))
+    try:
+      result = answer(url.path,query)
+      status = 200
+    except (ValueError,SystemExit) as e: # election.py reports errors using sys.exit()
+      result = {'error':str(e)}
+      status = 400
+    body = (json.dumps(result)+"\n").encode('utf-8')
+    self.send_response(status)
+    self.send_header('Content-Type','application/json')
+    self.send_header('Content-Length',str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+if __name__=='__main__':
+  main()